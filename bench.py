@@ -0,0 +1,241 @@
+from typing import Callable, Dict, List
+import json
+import pickle
+import sys
+import tempfile
+import time
+
+from span import Source, SourceStream
+from compilation_ctx import CompilationCtx
+from preprocessing.tokenized_stream import TokenizedStream
+from preprocessing.tokenizer.string import StringLiteral
+from preprocessing.token_buffer import TokenBuffer
+from preprocessing.export import export_tokens, read_column
+from preprocessing.directives import DirectiveExecutionContext, preprocess
+
+
+# Runs fn a few times and prints the best time
+def measure(name: str, fn: Callable[[], object], repeat: int = 3) -> None:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<40}{best * 1000:>12.2f} ms")
+
+
+def tokenize_text(text: str, elide_whitespace: bool = False) -> TokenizedStream:
+    return TokenizedStream.tokenize(SourceStream(Source("<bench>", text), 0), None, elide_whitespace)
+
+
+def preprocess_text(text: str, elide_whitespace: bool = False) -> TokenizedStream:
+    tokens = tokenize_text(text, elide_whitespace)
+    preprocess(tokens, DirectiveExecutionContext(CompilationCtx("<bench>")))
+    return tokens
+
+
+# The spellings of the string literals text preprocesses to
+def string_literals(text: str, elide_whitespace: bool) -> List[str]:
+    tokens = preprocess_text(text, elide_whitespace)
+    tokens.idx = tokens.entries[tokens.end].next
+    return [el.span.contents() for el in tokens.collect() if isinstance(el, StringLiteral)]
+
+
+def bench_literals() -> None:
+    blob = "abcdefghijklmnopqrstuvwxyz0123456789" * (1 << 16)  # ~2.3 MB
+    escaped = "ab\\n\\x41\\\"\\\\" * (1 << 16)
+
+    measure("plain 2.3MB string literal", lambda: tokenize_text('"' + blob + '"'))
+    measure("escaped string literal", lambda: tokenize_text('"' + escaped + '"'))
+    measure(
+        "escaped string literal, decoded",
+        lambda: tokenize_text('"' + escaped + '"').collect()[0].contents,  # type: ignore
+    )
+    measure("1k char literals", lambda: tokenize_text("'a' '\\n' '\\x7f' " * 1000))
+
+
+def bench_whitespace() -> None:
+    license_header = "/*\n" + " * Permission is hereby granted, free of charge...\n" * 20000 + " */\n"
+    line_comments = "// Permission is hereby granted, free of charge... \\\n\n" * 20000
+    indented = ("        \n" * 8 + "x\n") * 5000
+    declarations = "static const unsigned long x; // x\n" * 5000
+
+    measure("1MB block comment", lambda: tokenize_text(license_header))
+    measure("20k line comments", lambda: tokenize_text(line_comments))
+    measure("5k indented lines", lambda: tokenize_text(indented))
+    measure("5k indented lines, elided", lambda: tokenize_text(indented, True))
+    measure("5k commented declarations", lambda: tokenize_text(declarations))
+    measure("5k commented declarations, elided", lambda: tokenize_text(declarations, True))
+
+
+def bench_identifiers() -> None:
+    declarations = "static const unsigned long long some_identifier_name_42;\n" * 5000
+    unicode_names = "int größe_änderung = überlauf;\n" * 5000
+    numbers = "0x1234ULL 1.5e+10f 42u " * 5000
+
+    measure("5k ASCII declarations", lambda: tokenize_text(declarations))
+    measure("5k non-ASCII declarations", lambda: tokenize_text(unicode_names))
+    measure("15k numbers with suffixes", lambda: tokenize_text(numbers))
+
+
+def bench_numbers() -> None:
+    table = "".join(f"0x{i:08x}u, {i}.{i % 7}e-3f, " for i in range(5000))
+
+    measure("generated table, 10k numbers", lambda: tokenize_text(table))
+    measure(
+        "generated table, evaluated",
+        lambda: [
+            el.value  # type: ignore
+            for el in tokenize_text(table).collect()
+            if el.__class__.__name__ == "PPNumber"
+        ],
+    )
+
+
+def bench_phases() -> None:
+    macro = ("#define LONG_MACRO(a, b) \\\n    do { \\\n        f(a??(b??)); \\\n    } while (0)\n") * 5000
+    clean = macro.replace("\\\n", " \n").replace("??(", "[").replace("??)", "]")
+
+    measure("5k spliced macros with trigraphs", lambda: tokenize_text(macro))
+    measure("same without splices or trigraphs", lambda: tokenize_text(clean))
+
+
+# Handing a pre-lexed header to another process: pickling the elements, against a shared
+# TokenBuffer that is attached to and decoded lazily
+def bench_token_buffer() -> None:
+    header = "extern int some_function(const char *name, unsigned long size);\n" * 2000
+    stream = tokenize_text(header)
+    elements = stream.collect()
+
+    def shared(materialize: bool) -> None:
+        shm = TokenBuffer.encode(stream).share()
+        buf, attached = TokenBuffer.attach(shm.name)
+        if materialize:
+            buf.to_stream()
+        buf.release()
+        attached.close()
+        shm.close()
+        shm.unlink()
+
+    measure("pickle + unpickle 38k elements", lambda: pickle.loads(pickle.dumps(elements)))
+    measure("share + attach", lambda: shared(False))
+    measure("share + attach + materialize", lambda: shared(True))
+
+
+# Writing the tokens of a header for analysis, as a JSON object per element against
+# .npy columns, and summing a column of the export again
+def bench_export() -> None:
+    header = "extern int some_function(const char *name, unsigned long size);\n" * 2000
+    elements = tokenize_text(header).collect()
+
+    def as_json() -> str:
+        return json.dumps(
+            [
+                {"kind": el.__class__.__name__, "start": el.span.start, "end": el.span.end}
+                for el in elements
+            ]
+        )
+
+    def sum_ends(directory: str) -> int:
+        ends = read_column(f"{directory}/end.npy")
+        total = sum(ends)
+        ends.release()
+        return total
+
+    with tempfile.TemporaryDirectory() as directory:
+        measure("38k elements as JSON", as_json)
+        measure("38k elements as .npy columns", lambda: export_tokens(elements, directory))
+        measure("sum a memory mapped column", lambda: sum_ends(directory))
+
+
+# Logging macros invoked with the same arguments over and over, which are expanded once,
+# against the same number of invocations that all differ
+def bench_expansion() -> None:
+    macros = (
+        "#define LOG(level, ...) log_message(level, __FILE__, __VA_ARGS__)\n"
+        "#define CHECK(cond) do { if (!(cond)) LOG(ERROR, #cond); } while (0)\n"
+        "#define ERROR 3\n"
+    )
+    repeated = macros + "CHECK(ptr != NULL && size > 0);\n" * 5000
+    distinct = macros + "".join(f"CHECK(ptr != NULL && size > {i});\n" for i in range(5000))
+
+    measure("5k identical invocations", lambda: preprocess_text(repeated))
+    measure("5k distinct invocations", lambda: preprocess_text(distinct))
+
+    # Arguments passed down through layers of macros, as metaprogramming libraries do,
+    # and arguments that are ignored or only stringized, which are never expanded
+    layers = "#define L0(x) x\n" + "".join(f"#define L{k}(x) L{k - 1}(x)\n" for k in range(1, 30))
+    passed = macros + layers + "".join(
+        f"L29(CHECK(i > {i}) + {' + '.join(f'v{j}' for j in range(50))})\n" for i in range(200)
+    )
+    ignored = (
+        macros + "#define FIRST(a, ...) a\n#define NAME(x) #x\n"
+        + "".join(f"FIRST({i}, CHECK(a), CHECK(b)) NAME(CHECK(c > {i}))\n" for i in range(5000))
+    )
+
+    measure("200 arguments through 30 layers", lambda: preprocess_text(passed))
+    measure("5k ignored or stringized arguments", lambda: preprocess_text(ignored))
+
+
+# Long ## chains and large stringized arguments, which are built up and lexed in one go.
+# Checks first that # spells arguments the same with whitespace elided as without
+def bench_operators() -> None:
+    chain = "#define CHAIN " + " ## ".join(f"p{i}" for i in range(2000)) + "\nCHAIN\n"
+    params = ", ".join(f"a{i}" for i in range(500))
+    param_chain = f"#define JOIN({params}) " + " ## ".join(f"a{i}" for i in range(500)) + "\n"
+    for k in range(10):
+        param_chain += "JOIN(" + ", ".join(f"x{k}_{i}" for i in range(500)) + ")\n"
+    stringized = '#define STR(x) #x\nSTR(' + 'a + "b\\n" ' * 20000 + ")\n"
+
+    with open("test_src/stringize_spacing.c") as spacing_file:
+        spacing = spacing_file.read()
+    for text in (spacing, stringized):
+        if string_literals(text, True) != string_literals(text, False):
+            raise AssertionError("# spells arguments differently with whitespace elided")
+
+    measure("2k token ## chain", lambda: preprocess_text(chain))
+    measure("10x 500 parameter ## chain", lambda: preprocess_text(param_chain))
+    measure("# of a 60k token argument", lambda: preprocess_text(stringized))
+    measure("# of a 60k token argument, elided", lambda: preprocess_text(stringized, True))
+
+
+# Expansions nested thousands deep, past what recursing in Python would allow: a chain of
+# macros each invoking the next, arguments nested inside each other, and repetition
+# macros like the ones in Boost.PP, where REPn expands to n invocations of m
+def bench_nesting() -> None:
+    depth = 3000
+    chain = "#define M0(x) x\n" + "".join(f"#define M{k}(x) M{k - 1}(x)\n" for k in range(1, depth))
+    chain += f"M{depth - 1}(1)\n"
+    # Each level rescans the whole expansion of the one inside it, which takes quadratic
+    # time however it's done
+    arguments = "#define F(x) (x)\n" + "F(" * 1000 + "1" + ")" * 1000 + "\n"
+    repetition = "#define REP0(m, x)\n" + "".join(
+        f"#define REP{k}(m, x) REP{k - 1}(m, x) m(x, {k})\n" for k in range(1, 500)
+    )
+    repetition += "#define ITEM(x, k) x##k,\n" + "".join(f"REP499(ITEM, a{i})\n" for i in range(10))
+
+    measure("3k deep macro chain", lambda: preprocess_text(chain))
+    measure("1k deep nested arguments", lambda: preprocess_text(arguments))
+    measure("10x 500 deep repetition", lambda: preprocess_text(repetition))
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    "literals": bench_literals,
+    "whitespace": bench_whitespace,
+    "identifiers": bench_identifiers,
+    "numbers": bench_numbers,
+    "phases": bench_phases,
+    "token_buffer": bench_token_buffer,
+    "export": bench_export,
+    "expansion": bench_expansion,
+    "operators": bench_operators,
+    "nesting": bench_nesting,
+}
+
+
+# Usage: python bench.py [benchmark...]. Runs every benchmark if none are given
+if __name__ == "__main__":
+    names: List[str] = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -3,7 +3,9 @@ from typing import List, Dict, Optional
 from enum import IntEnum
 import os
 
-from span import Source
+from span import Source, SOURCES
+from stats import STATS
+from prefetch import IncludePrefetcher
 
 
 class BrainRotAmount(IntEnum):
@@ -33,6 +35,21 @@ class CompilationCtx:
         brain_rot_amount: Optional[BrainRotAmount] = None,
 
         compiler_path: Optional[str] = None,
+        stats_format: Optional[str] = None,
+        trace_file: Optional[str] = None,
+        trace_top: Optional[int] = None,
+        memory_profile: bool = False,
+        collect_errors: bool = False,
+        error_limit: Optional[int] = None,
+        preprocess_only: bool = False,
+        prefetch_includes: Optional[int] = None,
+        emit_pch: bool = False,
+        include_pch: Optional[str] = None,
+        configurations: Optional[List[Dict[str, str]]] = None,
+        macro_deps_file: Optional[str] = None,
+        max_macro_depth: Optional[int] = None,
+        elide_whitespace: bool = False,
+        export_tokens_dir: Optional[str] = None,
     ) -> None:
         self.input_file = input_file
         self.output_file = output_file or "a.out"
@@ -42,21 +59,86 @@ class CompilationCtx:
         self.brain_rot_amount = brain_rot_amount or BrainRotAmount.STANDARD
 
         self.compiler_path = compiler_path
+        self.stats_format = stats_format  # None if --stats was not passed
+        self.trace_file = trace_file
+        self.trace_top = 10 if trace_top is None else trace_top  # 0 for no report
+        self.memory_profile = memory_profile
+        self.collect_errors = collect_errors
+        self.error_limit = 20 if error_limit is None else error_limit  # 0 for no limit
+        self.preprocess_only = preprocess_only
+        self.prefetch_includes = 8 if prefetch_includes is None else prefetch_includes  # 0 to disable
+
+        self.emit_pch = emit_pch
+        self.include_pch = include_pch
+        self.configurations = configurations or []  # macros of each --config, on top of -D
+        self.macro_deps_file = macro_deps_file
+        self.max_macro_depth = 10000 if max_macro_depth is None else max_macro_depth  # 0 for no limit
+        self.elide_whitespace = elide_whitespace
+        self.export_tokens_dir = export_tokens_dir
+
+        # Made by the first prefetch_include, so contexts that never include anything don't
+        # have one
+        self.prefetcher: Optional[IncludePrefetcher] = None
 
     def input_source(self) -> Source:
-        with open(self.input_file, "r") as input_file:
-            return Source(self.input_file, input_file.read())
+        return self._load_source(self.input_file)
+
+    def file_source(self, f: str) -> Source:
+        return self._load_source(f)
+
+    # Files are only read the first time they're used, after that the Source registered
+    # for them in SOURCES is reused. contents is given if the file was prefetched
+    def _load_source(self, f: str, contents: Optional[str] = None) -> Source:
+        key = os.path.realpath(f)
+        source = SOURCES.find_file(key)
+        if source is not None:
+            STATS.count("files_reused")
+            return source
+
+        if contents is None:
+            with STATS.phase("io", {"file": f}):
+                with open(f, "r") as source_file:
+                    contents = source_file.read()
+        else:
+            STATS.count("files_prefetched")
+        STATS.count("files_read")
+        STATS.count("bytes_read", len(contents))
+        return SOURCES.add_file(key, f, contents)
+
+    def _include_candidates(self, filename: str, is_library: bool) -> List[str]:
+        paths = self.library_paths if is_library else self.include_paths
+        return [os.path.join(inc_path, filename) for inc_path in paths]
+
+    # Starts resolving and reading a header in the background, if prefetching is enabled.
+    # The result is used by a later find_include_source with the same arguments
+    def prefetch_include(self, filename: str, is_library: bool) -> None:
+        if not self.prefetch_includes:
+            return
+        if self.prefetcher is None:
+            self.prefetcher = IncludePrefetcher(self.prefetch_includes)
+        candidates = self._include_candidates(filename, is_library)
+        if self.prefetcher.request((filename, is_library), candidates):
+            STATS.count("prefetch_requests")
+        else:
+            STATS.count("prefetch_dropped")
 
     # Does not search libraries if is_library is False
     def find_include_source(self, filename: str, is_library: bool) -> Optional[Source]:
-        paths = self.library_paths if is_library else self.include_paths
-
-        for inc_path in paths:
-            f = os.path.join(inc_path, filename)
-            if os.path.isfile(f):
-                with open(f, "r") as include_file:
-                    return Source(f, include_file.read())
+        if self.prefetcher is not None:
+            with STATS.phase("io", {"file": filename}):
+                prefetched = self.prefetcher.take((filename, is_library))
+            if prefetched is not None:
+                if prefetched.path is None:
+                    return None
+                return self._load_source(prefetched.path, prefetched.contents)
+
+        for f in self._include_candidates(filename, is_library):
+            with STATS.phase("resolve"):
+                found = os.path.isfile(f)
+            if not found:
+                continue
 
+            return self._load_source(f)
 
         return None
 
@@ -68,18 +150,58 @@ class CompilationCtx:
             f"include_paths={self.include_paths!r}, "
             f"library_paths={self.library_paths!r}, "
             f"predefined_macros={self.predefined_macros!r}, "
-            f"brain_rot_amount={self.brain_rot_amount!r})"
+            f"brain_rot_amount={self.brain_rot_amount!r}, "
+            f"stats_format={self.stats_format!r}, "
+            f"trace_file={self.trace_file!r}, "
+            f"trace_top={self.trace_top!r}, "
+            f"memory_profile={self.memory_profile!r}, "
+            f"collect_errors={self.collect_errors!r}, "
+            f"error_limit={self.error_limit!r}, "
+            f"preprocess_only={self.preprocess_only!r}, "
+            f"prefetch_includes={self.prefetch_includes!r}, "
+            f"emit_pch={self.emit_pch!r}, "
+            f"include_pch={self.include_pch!r}, "
+            f"configurations={self.configurations!r}, "
+            f"macro_deps_file={self.macro_deps_file!r}, "
+            f"max_macro_depth={self.max_macro_depth!r}, "
+            f"elide_whitespace={self.elide_whitespace!r}, "
+            f"export_tokens_dir={self.export_tokens_dir!r})"
         )
 
     # Option format:
     #   <file>. Compile <file>. Can only appear once
     #   -o<file> or -o <file>: Output to <file>. Default a.out. Can only appear once
+    #   -E: Only preprocess, writing the preprocessed tokens to the output file. -o - for stdout
+    #   -emit-pch: Preprocess <file> as a prefix header, and write a snapshot of the macros it
+    #       leaves defined to the output file
+    #   -include-pch <file>: Start with the macros of a snapshot made by -emit-pch. A snapshot
+    #       whose files have changed since is made again
     #   -I<path> or -I <path>: Include <path> for file includes. Can appear multiple times
     #   -L<path> or -L <path>: Include <path> for library includes. Can appear multiple times
     #   -D<name>=<code> or -D <name>=<code>: Define macro <name> to be <code>
     #   -D<name> or -D <name>: Define macro <name> to be 1
     #
     #   -fno-brain-rot, -fextra-brain-rot: Set brain rot amount
+    #   -fcollect-errors: Keep going after errors, and report all of them at the end
+    #   -ferror-limit=<n>: Stop after <n> errors with -fcollect-errors. 0 for no limit. Default 20
+    #   -fprefetch-includes=<n>: Read up to <n> headers in the background ahead of their #include. Default 8
+    #   -fno-prefetch-includes: Read headers only when their #include is executed
+    #   -fmax-macro-depth=<n>: Fail when macro expansions are nested more than <n> deep. 0 for no
+    #       limit. Default 10000
+    #   -felide-whitespace: Don't keep whitespace and comments as elements of the token stream,
+    #       only as flags on the token after them
+    #
+    #   --stats, --stats=table, --stats=json: Print phase timings and counters at exit
+    #   --trace=<file>: Write Chrome trace events to <file> and print the most expensive headers
+    #   --trace-top=<n>: Number of headers to list in the --trace report. 0 for no report. Default 10
+    #   --memstats: Print tracemalloc snapshots and live token memory by kind and file at exit
+    #   --macro-deps=<file>: Write the macros the input depended on, with the definitions seen and
+    #       a fingerprint of them, as JSON to <file>. <file>.<i> for the i:th --config
+    #   --config=<name>[=<code>],...: With -E, preprocess once more with these macros defined on
+    #       top of the -D ones, writing to <output>.<i>.<ext> for the i:th --config. Can appear
+    #       multiple times, and each file is only tokenized once for all of them
+    #   --export-tokens=<dir>: Write the preprocessed tokens to <dir> as .npy columns, with a
+    #       schema.json to read them by, see preprocessing/export.py
     #
     #   TODO following arguments
     #   -: Read from stdin
@@ -97,6 +219,21 @@ class CompilationCtx:
         brain_rot_amount = None
 
         compiler_path = None
+        stats_format = None
+        trace_file = None
+        trace_top = None
+        memory_profile = False
+        collect_errors = False
+        error_limit = None
+        preprocess_only = False
+        prefetch_includes = None
+        emit_pch = False
+        include_pch = None
+        configurations = []
+        macro_deps_file = None
+        max_macro_depth = None
+        elide_whitespace = False
+        export_tokens_dir = None
 
         argidx = 0
         while argidx < len(args) - 1:
@@ -131,6 +268,24 @@ class CompilationCtx:
 
                     output_file = name
                     continue
+                elif arg == "-E":
+                    preprocess_only = True
+                    continue
+                elif arg == "-emit-pch":
+                    emit_pch = True
+                    continue
+                elif arg == "-include-pch":
+                    argidx += 1
+                    if argidx >= len(args):
+                        raise CompilationCtxArgsParseException(
+                            "Expected path after -include-pch", argidx - 1
+                        )
+                    if include_pch is not None:
+                        raise CompilationCtxArgsParseException(
+                            "Multiple values for -include-pch", argidx - 1
+                        )
+                    include_pch = args[argidx]
+                    continue
                 elif arg[1] == "I" or arg[1] == "L":
                     is_library = arg[1] == "L"
                     name = None
@@ -176,6 +331,76 @@ class CompilationCtx:
                     elif arg == "-fextra-brain-rot":
                         brain_rot_amount = BrainRotAmount.EXTRA
                         continue
+                    elif arg == "-fcollect-errors":
+                        collect_errors = True
+                        continue
+                    elif arg.startswith("-ferror-limit="):
+                        try:
+                            error_limit = int(arg[len("-ferror-limit="):])
+                        except ValueError:
+                            raise CompilationCtxArgsParseException(
+                                f"Expected number in {arg}", argidx
+                            )
+                        continue
+                    elif arg.startswith("-fprefetch-includes="):
+                        try:
+                            prefetch_includes = int(arg[len("-fprefetch-includes="):])
+                        except ValueError:
+                            raise CompilationCtxArgsParseException(
+                                f"Expected number in {arg}", argidx
+                            )
+                        continue
+                    elif arg == "-fno-prefetch-includes":
+                        prefetch_includes = 0
+                        continue
+                    elif arg.startswith("-fmax-macro-depth="):
+                        try:
+                            max_macro_depth = int(arg[len("-fmax-macro-depth="):])
+                        except ValueError:
+                            raise CompilationCtxArgsParseException(
+                                f"Expected number in {arg}", argidx
+                            )
+                        continue
+                    elif arg == "-felide-whitespace":
+                        elide_whitespace = True
+                        continue
+                elif arg[1] == "-":
+                    if arg == "--stats" or arg.startswith("--stats="):
+                        stats_format = arg[len("--stats="):] or "table"
+                        if stats_format not in ["table", "json"]:
+                            raise CompilationCtxArgsParseException(
+                                f"Unknown stats format {stats_format}", argidx
+                            )
+                        continue
+                    elif arg.startswith("--trace="):
+                        trace_file = arg[len("--trace="):]
+                        continue
+                    elif arg == "--memstats":
+                        memory_profile = True
+                        continue
+                    elif arg.startswith("--export-tokens="):
+                        export_tokens_dir = arg[len("--export-tokens="):]
+                        continue
+                    elif arg.startswith("--macro-deps="):
+                        macro_deps_file = arg[len("--macro-deps="):]
+                        continue
+                    elif arg.startswith("--config="):
+                        config = {}
+                        for macro in arg[len("--config="):].split(","):
+                            if not macro:
+                                continue
+                            name, eq, code = macro.partition("=")
+                            config[name] = code if eq else "1"
+                        configurations.append(config)
+                        continue
+                    elif arg.startswith("--trace-top="):
+                        try:
+                            trace_top = int(arg[len("--trace-top="):])
+                        except ValueError:
+                            raise CompilationCtxArgsParseException(
+                                f"Expected number in {arg}", argidx
+                            )
+                        continue
 
                 raise CompilationCtxArgsParseException(f"Unknown option {arg}", argidx)
             else:
@@ -187,6 +412,12 @@ class CompilationCtx:
 
         if input_file is None:
             raise CompilationCtxArgsParseException("Missing input file!")
+        if configurations and not preprocess_only:
+            raise CompilationCtxArgsParseException("--config can only be used with -E")
+        if configurations and (emit_pch or include_pch is not None):
+            raise CompilationCtxArgsParseException("--config can't be used with precompiled headers")
+        if configurations and export_tokens_dir is not None:
+            raise CompilationCtxArgsParseException("--config can't be used with --export-tokens")
 
 
         return CompilationCtx(
@@ -199,4 +430,19 @@ class CompilationCtx:
             brain_rot_amount=brain_rot_amount,
 
             compiler_path=compiler_path,
+            stats_format=stats_format,
+            trace_file=trace_file,
+            trace_top=trace_top,
+            memory_profile=memory_profile,
+            collect_errors=collect_errors,
+            error_limit=error_limit,
+            preprocess_only=preprocess_only,
+            prefetch_includes=prefetch_includes,
+            emit_pch=emit_pch,
+            include_pch=include_pch,
+            configurations=configurations,
+            macro_deps_file=macro_deps_file,
+            max_macro_depth=max_macro_depth,
+            elide_whitespace=elide_whitespace,
+            export_tokens_dir=export_tokens_dir,
         )
@@ -0,0 +1,56 @@
+from __future__ import annotations
+from typing import List, Dict, Optional, TextIO
+import sys
+
+from span import Span, Source, MarkColor
+
+
+class Diagnostic:
+    def __init__(self, kind: str, msg: str, span: Span) -> None:
+        self.kind = kind  # e.g. "Tokenization error"
+        self.msg = msg
+        self.span = span
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.kind}: {self.msg!r})"
+
+
+class TooManyErrors(Exception):
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+
+
+# Collects errors instead of stopping at the first one. Enabled by -fcollect-errors.
+# The tokenizer and preprocess skip to the end of the offending line and keep going
+class Diagnostics:
+    def __init__(self, limit: int = 0) -> None:
+        self.limit = limit  # 0 for no limit
+        self.errors: List[Diagnostic] = []
+
+    # Raises TooManyErrors once the limit is reached
+    def add(self, kind: str, msg: str, span: Span) -> None:
+        self.errors.append(Diagnostic(kind, msg, span))
+        if self.limit and len(self.errors) >= self.limit:
+            raise TooManyErrors(self.limit)
+
+    def by_source(self) -> Dict[Source, List[Diagnostic]]:
+        grouped: Dict[Source, List[Diagnostic]] = {}
+        for diag in self.errors:
+            grouped.setdefault(diag.span.source, []).append(diag)
+        for diags in grouped.values():
+            diags.sort(key=lambda diag: diag.span.start)
+        return grouped
+
+    # One print_spans call per file, with every error in it marked
+    def render(self, file: Optional[TextIO] = None) -> None:
+        out = file or sys.stdout
+
+        for source, diags in self.by_source().items():
+            out.write(f"{source.filename}: {len(diags)} error(s)\n")
+            for diag in diags:
+                line, col = source.coords_for_offset(diag.span.start)
+                out.write(f"  {line + 1}:{col + 1}: {diag.kind}: {diag.msg}\n")
+            source.print_spans([(diag.span, MarkColor.ERROR_RED) for diag in diags], file=out)
+
+        if self.limit and len(self.errors) >= self.limit:
+            out.write(f"Too many errors emitted ({self.limit}), stopping now\n")
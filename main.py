@@ -5,36 +5,117 @@ from preprocessing.directives import (
     preprocess,
     DirectiveExecutionContext,
     DirectiveException,
+    define_predefined_macros,
+    MacroDependencies,
+    write_macro_dependencies,
 )
+from preprocessing.configurations import preprocess_configurations
 from compilation_ctx import CompilationCtx
+from stats import STATS
+from memprofile import MEMORY
+from diagnostics import Diagnostics, TooManyErrors
+from preprocessing.output import BackgroundWriter, PreprocessedOutput
+from preprocessing.snapshot import SnapshotError, include_snapshot, save_snapshot
+from preprocessing.export import export_tokens
+from typing import Optional
 import traceback
+import sys
 
 from span import Span, SourceStream, Source, MarkColor
 
 if __name__ == "__main__":
-    args = ["main.py", "-Dbeans", "-fno-brain-rot", "test_src/main.c", "-I", "test_src", "-L", "/Library/Developer/CommandLineTools/SDKs/MacOSX11.3.sdk/usr/include"]
+    args = sys.argv
+    if len(args) <= 1:
+        args = ["main.py", "-Dbeans", "-fno-brain-rot", "test_src/main.c", "-I", "test_src", "-L", "/Library/Developer/CommandLineTools/SDKs/MacOSX11.3.sdk/usr/include"]
 
     ctx = CompilationCtx.from_args(args)
+    STATS.enabled = ctx.stats_format is not None or ctx.trace_file is not None
+    if ctx.trace_file is not None:
+        STATS.trace_events = []
+    MEMORY.enabled = ctx.memory_profile
+
+    diagnostics = Diagnostics(ctx.error_limit) if ctx.collect_errors else None
+
+    output = None
+    out_file = sys.stdout
+    if ctx.preprocess_only and not ctx.configurations:
+        out_file = sys.stdout if ctx.output_file == "-" else open(ctx.output_file, "w", buffering=1 << 20)
+        output = PreprocessedOutput(BackgroundWriter(out_file))
+
+    # Started once the output is set up, so its buffer isn't counted as preprocessing memory
+    MEMORY.start()
 
     data = SourceStream(ctx.input_source(), 0)
 
     try:
-        tokenized = TokenizedStream.tokenize(data)
+        if ctx.configurations:
+            preprocess_configurations(ctx, data.source, diagnostics)
+        else:
+            tokenized = TokenizedStream.tokenize(data, diagnostics, ctx.elide_whitespace)
+            if STATS.enabled:
+                STATS.record_file_tokens(data.source, len(tokenized.entries) - 1)
+            MEMORY.snapshot("tokenize")
 
-        dectx = DirectiveExecutionContext(ctx)
-        preprocess(tokenized, dectx)
-        tokenized.idx = tokenized.entries[tokenized.end].next
+            dectx = DirectiveExecutionContext(ctx, diagnostics, output)
+            define_predefined_macros(dectx, ctx.predefined_macros)
+            if ctx.include_pch is not None:
+                include_snapshot(dectx, ctx.include_pch)
+            dectx.macros.dependencies = MacroDependencies()
+            preprocess(tokenized, dectx)
+            if ctx.macro_deps_file is not None:
+                write_macro_dependencies(dectx.macros.dependencies, ctx.macro_deps_file)
+            MEMORY.snapshot("preprocess")
+            MEMORY.account_stream(tokenized)
+            tokenized.idx = tokenized.entries[tokenized.end].next
 
-        for le in tokenized.collect():
-            if isinstance(le, Identifier):
-                print(repr(le))
-                le.span.source.print_spans([(le.span, MarkColor.INFO_BLUE)])
+            if ctx.export_tokens_dir is not None:
+                with STATS.phase("export"):
+                    export_tokens(tokenized.collect(), ctx.export_tokens_dir)
+            if ctx.emit_pch:
+                save_snapshot(dectx, ctx.output_file, ctx.input_file)
+            elif output is None:
+                for le in tokenized.collect():
+                    if isinstance(le, Identifier):
+                        print(repr(le))
+                        le.span.source.print_spans([(le.span, MarkColor.INFO_BLUE)])
 
     except TokenizeException as e:
         traceback.print_exc()
         print("Tokenization error:", e.msg)
-        data.source.print_spans([(e.span, MarkColor.ERROR_RED)])
+        e.span.source.print_spans([(e.span, MarkColor.ERROR_RED)])
     except DirectiveException as e:
         # traceback.print_exc()
         print("Directive expansion error:", e.msg)
-        data.source.print_spans([(e.span, MarkColor.ERROR_RED)])
+        e.span.source.print_spans([(e.span, MarkColor.ERROR_RED)])
+    except SnapshotError as e:
+        print("Precompiled header error:", e.msg)
+    except TooManyErrors:
+        pass
+    finally:
+        if ctx.prefetcher is not None:
+            ctx.prefetcher.shutdown()
+        # Reported last, so it doesn't keep the other reports from being printed
+        write_error: Optional[Exception] = None
+        if output is not None:
+            try:
+                try:
+                    with STATS.phase("output"):
+                        output.finish()
+                finally:
+                    if out_file is not sys.stdout:
+                        out_file.close()
+            except Exception as e:
+                write_error = e
+        if diagnostics is not None:
+            diagnostics.render()
+        if ctx.stats_format is not None:
+            print(STATS.render(ctx.stats_format), file=sys.stderr)
+        if ctx.trace_file is not None:
+            STATS.write_trace(ctx.trace_file)
+            if ctx.trace_top:
+                print(STATS.render_header_report(ctx.trace_top), file=sys.stderr)
+        if ctx.memory_profile:
+            print(MEMORY.render(), file=sys.stderr)
+        if write_error is not None:
+            print(f"Error writing {ctx.output_file}: {write_error}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,153 @@
+from __future__ import annotations
+from typing import Dict, List, Tuple, Set, Any
+from enum import Enum
+import sys
+import tracemalloc
+
+from span import Span, Source
+from preprocessing.tokenizer.tokenize import LexicalElement
+from preprocessing.tokenized_stream import TokenizedStream
+
+
+class ObjectStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.bytes = 0
+
+
+# Shallow size of an object, including the instance dict
+def _shallow_size(obj: Any) -> int:
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+# Size of an object and the values only it refers to. Spans, Sources, enums and nested
+# elements are accounted for on their own
+def _owned_size(obj: Any, seen: Set[int]) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = _shallow_size(obj)
+    values: List[Any] = []
+    if isinstance(obj, (list, tuple)):
+        values = list(obj)
+    elif hasattr(obj, "__dict__"):
+        values = list(obj.__dict__.values())
+
+    for value in values:
+        if isinstance(value, (Span, Source, Enum, LexicalElement)):
+            continue
+        if isinstance(value, (str, bytes, int, float, list, tuple)):
+            size += _owned_size(value, seen)
+    return size
+
+
+# Records tracemalloc snapshots between the preprocessor phases, and accounts for the
+# objects making up the final token stream. Enabled by passing --memstats
+class MemoryProfiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.snapshots: List[Tuple[str, tracemalloc.Snapshot, int, int]] = []
+
+        self.objects: Dict[str, ObjectStats] = {}
+        self.files: Dict[str, ObjectStats] = {}
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        tracemalloc.start()
+        self.snapshot("start")
+
+    def snapshot(self, label: str) -> None:
+        if not self.enabled:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        self.snapshots.append((label, snapshot, current, peak))
+
+    def _add(self, kind: str, filename: str, size: int) -> None:
+        obj = self.objects.get(kind)
+        if obj is None:
+            obj = self.objects[kind] = ObjectStats()
+        obj.count += 1
+        obj.bytes += size
+
+        f = self.files.get(filename)
+        if f is None:
+            f = self.files[filename] = ObjectStats()
+        f.count += 1
+        f.bytes += size
+
+    def _add_element(self, el: LexicalElement, seen: Set[int]) -> None:
+        filename = str(el.span.source.filename)
+        self._add(el.__class__.__name__, filename, _owned_size(el, seen))
+
+        # Subelements, such as the digits of a PPNumber
+        for value in el.__dict__.values():
+            children = value if isinstance(value, list) else [value]
+            for child in children:
+                if isinstance(child, LexicalElement) and id(child) not in seen:
+                    self._add_element(child, seen)
+
+        if id(el.span) not in seen:
+            seen.add(id(el.span))
+            self._add("Span", filename, _shallow_size(el.span))
+
+        source = el.span.source
+        if id(source) not in seen:
+            seen.add(id(source))
+            source_size = (
+                _shallow_size(source)
+                + sys.getsizeof(source.contents)
+                + sys.getsizeof(source.lines)
+                + sum(sys.getsizeof(line) for line in source.lines)
+            )
+            self._add("Source", filename, source_size)
+
+    # Walks every entry of the stream, including ones outside of its current range
+    def account_stream(self, stream: TokenizedStream) -> None:
+        if not self.enabled:
+            return
+        seen: Set[int] = set()
+        for entry in stream.entries.values():
+            self._add("Entry", str(entry.element.span.source.filename), _shallow_size(entry))
+            self._add_element(entry.element, seen)
+
+    def render(self, top_n: int = 10) -> str:
+        out: List[str] = []
+
+        out.append(f"{'Snapshot':<24}{'current KiB':>14}{'peak KiB':>14}")
+        for label, _, current, peak in self.snapshots:
+            out.append(f"  {label:<22}{current / 1024:>14.1f}{peak / 1024:>14.1f}")
+        out.append("")
+
+        for (label_a, snap_a, _, _), (label_b, snap_b, _, _) in zip(
+            self.snapshots, self.snapshots[1:]
+        ):
+            out.append(f"Top {top_n} allocation sites, {label_a} -> {label_b}")
+            for diff in snap_b.compare_to(snap_a, "lineno")[:top_n]:
+                frame = diff.traceback[0]
+                site = f"{frame.filename}:{frame.lineno}"
+                out.append(
+                    f"  {site[-60:]:<60}{diff.size_diff / 1024:>12.1f} KiB{diff.count_diff:>10}"
+                )
+            out.append("")
+
+        def object_table(title: str, table: Dict[str, ObjectStats]) -> None:
+            out.append(f"{title:<40}{'count':>10}{'KiB':>12}")
+            for name, stats in sorted(table.items(), key=lambda kv: -kv[1].bytes):
+                out.append(f"  {name[-38:]:<38}{stats.count:>10}{stats.bytes / 1024:>12.1f}")
+            out.append("")
+
+        object_table("Live objects by kind", self.objects)
+        object_table("Live objects by file", self.files)
+
+        return "\n".join(out).rstrip("\n")
+
+
+MEMORY = MemoryProfiler()
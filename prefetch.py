@@ -0,0 +1,75 @@
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import os
+import threading
+
+from span import SOURCES
+
+
+# (filename, is_library), as passed to CompilationCtx.find_include_source
+PrefetchKey = Tuple[str, bool]
+
+
+class Prefetched:
+    def __init__(self, path: Optional[str], contents: Optional[str]) -> None:
+        self.path = path  # None if no candidate exists
+        self.contents = contents  # None if the file had already been loaded
+
+
+# Resolves and reads include files on a thread pool, so the file system is waited on
+# while earlier parts of the translation unit are preprocessed. Requests are made when a
+# file has been tokenized, for every header name in it, and are dropped when max_in_flight
+# reads are already running. Workers don't touch STATS, which isn't thread-safe
+class IncludePrefetcher:
+    def __init__(self, max_in_flight: int = 8) -> None:
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+        self.pool: Optional[ThreadPoolExecutor] = None  # started on the first request
+        self.requests: Dict[PrefetchKey, Future[Optional[Prefetched]]] = {}
+
+    # Returns False if the request was dropped
+    def request(self, key: PrefetchKey, candidates: List[str]) -> bool:
+        if key in self.requests:
+            return True
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.max_in_flight, thread_name_prefix="prefetch")
+        self.requests[key] = self.pool.submit(self._resolve, candidates)
+        return True
+
+    def _resolve(self, candidates: List[str]) -> Optional[Prefetched]:
+        try:
+            for f in candidates:
+                if not os.path.isfile(f):
+                    continue
+                if SOURCES.find_file(os.path.realpath(f)) is not None:
+                    return Prefetched(f, None)
+                with open(f, "r") as include_file:
+                    return Prefetched(f, include_file.read())
+            return Prefetched(None, None)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    # Waits for the result of a request. None if there was no request for key, or if it
+    # failed, in which case the caller should load the file itself to get the error
+    def take(self, key: PrefetchKey) -> Optional[Prefetched]:
+        future = self.requests.pop(key, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        self.requests.clear()
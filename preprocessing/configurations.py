@@ -0,0 +1,138 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, TextIO, Tuple
+import io
+import os
+import shutil
+import sys
+
+from span import Source, SourceStream
+from compilation_ctx import CompilationCtx
+from diagnostics import Diagnostics
+from stats import STATS
+from .tokenizer.tokenize import LexicalElement
+from .tokenized_stream import TokenizedStream
+from .directives import (
+    DirectiveExecutionContext,
+    MacroDependencies,
+    define_predefined_macros,
+    preprocess,
+    write_macro_dependencies,
+)
+from .output import BackgroundWriter, PreprocessedOutput, TeeFile
+
+
+def describe(macros: Dict[str, str]) -> str:
+    return " ".join(f"-D{name}={code}" for name, code in sorted(macros.items())) or "(no macros)"
+
+
+# Where the output of configuration i goes: out.i becomes out.0.i, out.1.i, ...
+def output_path(output_file: str, i: int) -> str:
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.{i}{ext}"
+
+
+# The macros of every configuration, on top of the -D macros
+def configuration_macros(ctx: CompilationCtx) -> List[Dict[str, str]]:
+    return [{**ctx.predefined_macros, **config} for config in ctx.configurations]
+
+
+# Preprocesses source once per --config, writing output_path(ctx.output_file, i) for
+# configuration i, or everything to stdout one after the other for -o -.
+# Each file is only tokenized once, however many configurations there are. The macros
+# every configuration agrees on are defined once, and each configuration forks that
+# context, copying the macro table only when it defines something of its own.
+# Configurations with the same macros are preprocessed once, and their outputs written
+# together. A configuration whose macros only differ from one already preprocessed in
+# macros the translation unit never looked up, as recorded by MacroDependencies, would
+# come out the same, so it gets a copy of that output instead of being preprocessed again
+def preprocess_configurations(
+    ctx: CompilationCtx, source: Source, diagnostics: Optional[Diagnostics]
+) -> None:
+    configs = configuration_macros(ctx)
+
+    groups: Dict[Tuple[Tuple[str, str], ...], List[int]] = {}
+    for i, macros in enumerate(configs):
+        groups.setdefault(tuple(sorted(macros.items())), []).append(i)
+    STATS.count("configurations", len(configs))
+    STATS.count("distinct_configurations", len(groups))
+
+    common = {
+        name: code
+        for name, code in configs[0].items()
+        if all(macros.get(name) == code for macros in configs[1:])
+    }
+
+    token_cache: Dict[Source, List[LexicalElement]] = {}
+    elements = TokenizedStream.tokenize(
+        SourceStream(source, 0), diagnostics, ctx.elide_whitespace
+    ).collect()
+    token_cache[source] = elements
+    if STATS.enabled:
+        STATS.record_file_tokens(source, len(elements))
+
+    base = DirectiveExecutionContext(ctx, diagnostics, None, token_cache)
+    define_predefined_macros(base, common)
+
+    # The configurations preprocessed so far: what their output depended on, its
+    # fingerprint, the configuration it was written for, and the output itself if it went
+    # to stdout
+    runs: List[Tuple[MacroDependencies, str, int, Optional[str]]] = []
+    for indices in groups.values():
+        macros = configs[indices[0]]
+        dectx = base.fork()
+        define_predefined_macros(
+            dectx, {name: code for name, code in macros.items() if name not in common}
+        )
+        if ctx.output_file == "-":
+            sys.stdout.write("".join(f"/* configuration {i}: {describe(macros)} */\n" for i in indices))
+
+        for dependencies, fingerprint, first, text in runs:
+            if dependencies.fingerprint(dectx.macros) == fingerprint:
+                STATS.count("reused_configurations", len(indices))
+                if text is not None:
+                    sys.stdout.write(text)
+                else:
+                    for i in indices:
+                        shutil.copyfile(
+                            output_path(ctx.output_file, first), output_path(ctx.output_file, i)
+                        )
+                break
+        else:
+            dependencies, text = _preprocess_configuration(ctx, dectx, elements, indices)
+            runs.append((dependencies, dependencies.fingerprint(), indices[0], text))
+
+        if ctx.macro_deps_file is not None:
+            for i in indices:
+                write_macro_dependencies(dependencies, f"{ctx.macro_deps_file}.{i}")
+
+
+# Preprocesses elements with the macros of dectx, writing the output of the configurations
+# indices. Returns what the output depended on, and the output if it went to stdout
+def _preprocess_configuration(
+    ctx: CompilationCtx,
+    dectx: DirectiveExecutionContext,
+    elements: List[LexicalElement],
+    indices: List[int],
+) -> Tuple[MacroDependencies, Optional[str]]:
+    files: List[TextIO] = []
+    captured: Optional[io.StringIO] = None
+    if ctx.output_file == "-":
+        captured = io.StringIO()
+        files.extend([sys.stdout, captured])
+    else:
+        files.extend(
+            open(output_path(ctx.output_file, i), "w", buffering=1 << 20) for i in indices
+        )
+    output = PreprocessedOutput(BackgroundWriter(TeeFile(files)))
+
+    try:
+        dectx.output = output
+        dependencies = dectx.macros.dependencies = MacroDependencies()
+        preprocess(TokenizedStream.from_list(elements), dectx)
+    finally:
+        with STATS.phase("output"):
+            output.finish()
+        for f in files:
+            if f is not sys.stdout and f is not captured:
+                f.close()
+    return dependencies, captured.getvalue() if captured is not None else None
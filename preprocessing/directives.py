@@ -1,6 +1,10 @@
 from __future__ import annotations
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Set, Any, Union, Optional, Iterator, Mapping, MutableMapping
 from abc import ABC, abstractmethod
+from functools import lru_cache
+import hashlib
+import json
+import os
 import time
 
 from .tokenizer.tokenize import LexicalElement, SpaceSequence
@@ -8,21 +12,27 @@ from span import Span, Source, PseudoFilename, MarkColor, SourceStream
 from .tokenized_stream import TokenizedStream, ElementKey
 
 from .tokenizer.punctuator import Punctuator, PunctuatorType
-from .tokenizer.identifier import Identifier
+from .tokenizer.identifier import Identifier, SYMBOLS
 from .tokenizer.string import StringLiteral, StringPrefix
 from .tokenizer.header_name import HeaderName
-from .tokenizer.number import PPNumber, Digit, Exponent, Dot
+from .tokenizer.number import PPNumber
 from compilation_ctx import CompilationCtx, BrainRotAmount
-
-PREDEFINED_MACROS_SOURCE = Source(PseudoFilename.PREDEFINED_MACROS, "")
+from stats import STATS
+from diagnostics import Diagnostics
+from .output import PreprocessedOutput
 
 
 class Macro(ABC):
+    body: List[LexicalElement]
+
     @abstractmethod
     def __repr__(self) -> str:
         pass
 
 
+VA_ARGS = SYMBOLS.intern("__VA_ARGS__")
+
+
 class FunctionMacro(Macro):
     def __init__(
         self, parameters: List[str], has_varargs: bool, body: List[LexicalElement]
@@ -31,6 +41,11 @@ class FunctionMacro(Macro):
         self.has_varargs = has_varargs
         self.body = body
 
+        # symbol -> index of the parameter
+        self.parameter_index = {SYMBOLS.intern(name): i for i, name in enumerate(parameters)}
+        if has_varargs:
+            self.parameter_index[VA_ARGS] = len(parameters)
+
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.parameters}{', ...' * self.has_varargs}, {self.body})"
 
@@ -75,35 +90,186 @@ def current_time() -> str:
 
 
 def make_str_macro(st: str) -> Macro:
-    span = Span(PREDEFINED_MACROS_SOURCE, 0, 0)
-    return ObjectMacro([StringLiteral(span, StringPrefix.NONE, st)])
+    spelling = '"' + st.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    source = Source(PseudoFilename.PREDEFINED_MACROS, spelling)
+    return ObjectMacro([StringLiteral(Span(source, 0, len(spelling)), StringPrefix.NONE, st)])
 
 
 def make_int_macro(num: int) -> Macro:
-    span = Span(PREDEFINED_MACROS_SOURCE, 0, 0)
-    digits: List[Union[Digit, Exponent, Dot, str]] = [
-        Digit(span, int(digit)) for digit in str(num)
-    ]
+    spelling = str(num)
+    source = Source(PseudoFilename.PREDEFINED_MACROS, spelling)
+    return ObjectMacro([PPNumber(Span(source, 0, len(spelling)))])
+
+
+# A stable description of a macro definition, None for an undefined macro
+def macro_identity(macro: Optional[Macro]) -> Optional[str]:
+    if macro is None:
+        return None
+    body = " ".join(
+        el.span.contents()
+        for el in macro.body
+        if not isinstance(el, SpaceSequence)
+    )
+    if isinstance(macro, FunctionMacro):
+        params = ", ".join(macro.parameters + ["..."] * macro.has_varargs)
+        return f"({params}) {body}"
+    return body
+
+
+# The macros a translation unit depended on from outside of itself: every name it
+# looked up before defining or undefining it itself, with the definition that was seen.
+# Recording starts once the -D macros and precompiled headers are in place, so a change
+# to them only matters if it changes one of these definitions.
+# Macros are recorded by symbol, and only reported by name
+class MacroDependencies:
+    def __init__(self) -> None:
+        self.seen: Dict[int, Optional[str]] = {}  # symbol -> macro_identity at the first lookup
+        self.uses: Dict[int, Set[str]] = {}  # symbol -> how it was used, e.g. "define"
+        self.local: Set[int] = set()  # symbols (un)defined by the translation unit
+
+    def record(self, symbol: int, use: str, macro: Optional[Macro]) -> None:
+        self.uses.setdefault(symbol, set()).add(use)
+        if symbol not in self.local and symbol not in self.seen:
+            self.seen[symbol] = macro_identity(macro)
+
+    # A hash of what was seen. Computing the same for another set of macros tells whether
+    # the translation unit would come out the same with them
+    def fingerprint(self, macros: Optional[Mapping[int, Macro]] = None) -> str:
+        seen = self.seen
+        if macros is not None:
+            seen = {symbol: macro_identity(macros.get(symbol)) for symbol in self.seen}
+        named = sorted((SYMBOLS.name(symbol), identity) for symbol, identity in seen.items())
+        return hashlib.sha256(json.dumps(named).encode()).hexdigest()
+
+    def to_json(self) -> Dict[str, Any]:
+        uses = sorted((SYMBOLS.name(symbol), symbol, uses) for symbol, uses in self.uses.items())
+        return {
+            "fingerprint": self.fingerprint(),
+            "macros": {
+                name: {"definition": self.seen.get(symbol), "uses": sorted(used)}
+                for name, symbol, used in uses
+            },
+        }
+
 
-    return ObjectMacro([PPNumber(span, digits)])
+def write_macro_dependencies(dependencies: MacroDependencies, path: str) -> None:
+    with open(path, "w") as deps_file:
+        json.dump(dependencies.to_json(), deps_file, indent=2)
+
+
+# The macros of a DirectiveExecutionContext, by the symbol of their name. fork() makes a
+# copy in constant time: both tables share the same dict until one of them is written to,
+# which copies it.
+# Directives look macros up through lookup(), so they're recorded in dependencies
+class MacroTable(MutableMapping[int, Macro]):
+    def __init__(self, macros: Optional[Dict[int, Macro]] = None) -> None:
+        self._macros: Dict[int, Macro] = macros if macros is not None else {}
+        self._shared = False
+        self.dependencies: Optional[MacroDependencies] = None
+        # Changed by every #define and #undef, so what was computed from the macros can be
+        # thrown away
+        self.generation = 0
+
+    def fork(self) -> MacroTable:
+        self._shared = True
+        other = MacroTable(self._macros)
+        other._shared = True
+        return other
+
+    # use says what the lookup is for: "define", "undef", "test" or "expand"
+    def lookup(self, symbol: int, use: str) -> Optional[Macro]:
+        macro = self._macros.get(symbol)
+        if self.dependencies is not None:
+            self.dependencies.record(symbol, use, macro)
+        return macro
+
+    def _own(self) -> None:
+        if self._shared:
+            STATS.count("macro_table_copies")
+            self._macros = dict(self._macros)
+            self._shared = False
+
+    def __getitem__(self, symbol: int) -> Macro:
+        return self._macros[symbol]
+
+    def __contains__(self, symbol: object) -> bool:
+        return symbol in self._macros
+
+    def __setitem__(self, symbol: int, macro: Macro) -> None:
+        self._own()
+        self._macros[symbol] = macro
+        self.generation += 1
+        if self.dependencies is not None:
+            self.dependencies.local.add(symbol)
+
+    def __delitem__(self, symbol: int) -> None:
+        self._own()
+        del self._macros[symbol]
+        self.generation += 1
+        if self.dependencies is not None:
+            self.dependencies.local.add(symbol)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._macros)
+
+    def __len__(self) -> int:
+        return len(self._macros)
+
+
+# Made once, so every context shares the macros and the Sources spelling them, and
+# __DATE__ and __TIME__ are when the first context was made. Not to be modified
+@lru_cache(maxsize=None)
+def builtin_macros() -> Dict[str, Macro]:
+    return {
+        # from section 6.10.8.1
+        "__DATE__": make_str_macro(current_date()),
+        "__STDC__": make_int_macro(0),  # TODO: Change this to 1!
+        "__STDC_HOSTED__": make_int_macro(1),
+        "__TIME__": make_str_macro(current_time()),
+    }
 
 
 # Stores things like currently defined macros, etc.
 # TODO: Store the current stack of includes here, to prevent files from recursively including themselves
 class DirectiveExecutionContext:
-    def __init__(self, compilation_ctx: CompilationCtx) -> None:
+    def __init__(
+        self,
+        compilation_ctx: CompilationCtx,
+        diagnostics: Optional[Diagnostics] = None,
+        output: Optional[PreprocessedOutput] = None,
+        token_cache: Optional[Dict[Source, List[LexicalElement]]] = None,
+    ) -> None:
         self.compilation_ctx = compilation_ctx
+        # If set, errors are collected here instead of raising DirectiveException
+        self.diagnostics = diagnostics
+        # If set, every token that is not part of a directive is written here (-E)
+        self.output = output
 
-        self.macros: Dict[str, Macro] = {
-            # from section 6.10.8.1
-            "__DATE__": make_str_macro(current_date()),
-            "__STDC__": make_int_macro(0),  # TODO: Change this to 1!
-            "__STDC_HOSTED__": make_int_macro(1),
-            "__TIME__": make_str_macro(current_time()),
-        }
+        # If set, the elements of every included file, so contexts sharing the cache only
+        # tokenize each file once
+        self.token_cache = token_cache
+
+        from .expansion import MacroExpander  # imports this module
+
+        self.macros = MacroTable(
+            {SYMBOLS.intern(name): macro for name, macro in builtin_macros().items()}
+        )
+        self.expander = MacroExpander(self)
         self.line_nr_offset = (
             0  # used by `#line` to control the behaviour of the __LINE__ macro
         )
+        # Real paths of the headers included so far, in the order they were first included
+        self.included_files: List[str] = []
+
+    # A copy of this context writing to output. The macro table is copied on write
+    def fork(self, output: Optional[PreprocessedOutput] = None) -> DirectiveExecutionContext:
+        other = DirectiveExecutionContext(
+            self.compilation_ctx, self.diagnostics, output, self.token_cache
+        )
+        other.macros = self.macros.fork()
+        other.line_nr_offset = self.line_nr_offset
+        other.included_files = list(self.included_files)
+        return other
 
 
 class DirectiveException(Exception):
@@ -116,60 +282,178 @@ class DirectiveError(DirectiveException):
     pass
 
 
+# Defines the macros given with -D, as if by #define directives. Values can be anything a
+# #define can take, so -D'F(x)=x' defines a function-like macro
+def define_predefined_macros(ctx: DirectiveExecutionContext, macros: Dict[str, str]) -> None:
+    if not macros:
+        return
+    lines = "".join(f"#define {name} {code}\n" for name, code in macros.items())
+    tokens = TokenizedStream.tokenize(
+        SourceStream(Source(PseudoFilename.PREDEFINED_MACROS, lines), 0),
+        elide_whitespace=ctx.compilation_ctx.elide_whitespace,
+    )
+
+    output, ctx.output = ctx.output, None
+    try:
+        preprocess(tokens, ctx)
+    finally:
+        ctx.output = output
+
+
+# Tokenizes an included file, or reuses its elements from ctx.token_cache
+def tokenize_source(source: Source, ctx: DirectiveExecutionContext) -> TokenizedStream:
+    elide_whitespace = ctx.compilation_ctx.elide_whitespace
+    if ctx.token_cache is None:
+        return TokenizedStream.tokenize(SourceStream(source, 0), ctx.diagnostics, elide_whitespace)
+
+    elements = ctx.token_cache.get(source)
+    if elements is None:
+        stream = TokenizedStream.tokenize(SourceStream(source, 0), ctx.diagnostics, elide_whitespace)
+        elements = ctx.token_cache[source] = stream.collect()
+        return stream
+    STATS.count("token_cache_hits")
+    return TokenizedStream.from_list(elements)
+
+
 # Modifies tokens in place, may throw DirectiveException
 def preprocess(tokens: TokenizedStream, ctx: DirectiveExecutionContext) -> None:
+    with STATS.phase("preprocess"):
+        prefetch_includes(tokens, ctx)
+        _preprocess(tokens, ctx)
+
+
+# Whether each lookup for header_name searches the library paths, in the order they're
+# tried. A "xyz" include falls back to <xyz> unless brain rot is reduced
+def include_lookups(header_name: HeaderName, ctx: DirectiveExecutionContext) -> List[bool]:
+    if ctx.compilation_ctx.brain_rot_amount <= BrainRotAmount.REDUCED:
+        return [not header_name.is_q]
+    if header_name.is_q:
+        return [False, True]
+    return [True]
+
+
+# Starts reading the headers named in tokens in the background, before their #include
+# directives are reached. Only the first lookup of each is prefetched
+def prefetch_includes(tokens: TokenizedStream, ctx: DirectiveExecutionContext) -> None:
+    if not ctx.compilation_ctx.prefetch_includes:
+        return
+
+    idx = tokens.idx
+    while idx != tokens.end:
+        entry = tokens.entries[idx]
+        if isinstance(entry.element, HeaderName):
+            is_library = include_lookups(entry.element, ctx)[0]
+            ctx.compilation_ctx.prefetch_include(entry.element.name, is_library)
+        idx = entry.next
+
+
+# Jumps from directive to directive using the index built by the tokenizer, writing the
+# tokens in between to the output in one go
+def _preprocess(tokens: TokenizedStream, ctx: DirectiveExecutionContext) -> None:
     while True:
-        start_key = tokens.idx
-        tok = tokens.pop_token()
-        if tok is None:
+        start_key = tokens.next_directive()
+        if start_key is None:
             break
-        if isinstance(tok, Punctuator) and tok.ty == PunctuatorType.HASH:
-            before = tokens.peek_element(-2)
-            if before is None or isinstance(before, SpaceSequence) and before.has_nl:
-                directive_name_ident = tokens.pop_token()
-                if directive_name_ident is None:
-                    raise DirectiveException(
-                        "File ended after directive start!", tok.span
-                    )
-                if not isinstance(directive_name_ident, Identifier):
-                    raise DirectiveException(
-                        "# followed by a non-identifier", directive_name_ident.span
-                    )
-                name = directive_name_ident.identifier
-
-                if name == "define":
-                    preprocess_define(directive_name_ident, tokens, ctx)
-                elif name == "undef":
-                    preprocess_undef(directive_name_ident, tokens, ctx)
-                elif name == "error":
-                    preprocess_error(directive_name_ident, tokens, ctx)
-                elif name == "include":
-                    preprocess_include(start_key, directive_name_ident, tokens, ctx)
-                elif name in ["if", "ifdef", "ifndef"]:
-                    preprocess_if_group(directive_name_ident, tokens, ctx)
-                elif name == "line":
-                    preprocess_line(directive_name_ident, tokens, ctx)
-                elif name == "pragma":
-                    preprocess_pragma(directive_name_ident, tokens, ctx)
-                else:
-                    # TODO: Should you actually emit an error here?
-                    # clang and gcc do, but the standard seems to say they should be ignored
-                    raise DirectiveException(
-                        f"Unknown directive {name}", directive_name_ident.span
-                    )
-                continue
+        _pass_tokens(tokens, start_key, ctx)
+
+        tok = tokens.pop_token()
+        assert isinstance(tok, Punctuator)
+        try:
+            preprocess_directive(start_key, tok, tokens, ctx)
+        except DirectiveException as e:
+            if ctx.diagnostics is None:
+                raise
+            kind = "#error" if isinstance(e, DirectiveError) else "Directive expansion error"
+            ctx.diagnostics.add(kind, e.msg, e.span)
+            # Skip the rest of the directive
+            get_directive_tokens(tokens)
+
+    _pass_tokens(tokens, tokens.end, ctx)
+
+
+# Expands the macros in the tokens up to until, which contain no directives
+def _pass_tokens(tokens: TokenizedStream, until: ElementKey, ctx: DirectiveExecutionContext) -> None:
+    start = tokens.idx
+    elements = tokens.pop_elements_until(until)
+    expanded = ctx.expander.expand_run(elements)
+    if expanded is None:
+        if ctx.output is not None:
+            ctx.output.write_tokens(elements)
+        return
+
+    result, locations = expanded
+    tokens.replace_range(start, until, TokenizedStream.from_list(result, []))
+    if ctx.output is not None:
+        ctx.output.write_tokens(result, locations)
+
+
+def preprocess_directive(
+    start_key: ElementKey,
+    hash_token: Punctuator,
+    tokens: TokenizedStream,
+    ctx: DirectiveExecutionContext,
+) -> None:
+    directive_name_ident = tokens.pop_token()
+    if directive_name_ident is None:
+        raise DirectiveException("File ended after directive start!", hash_token.span)
+    if not isinstance(directive_name_ident, Identifier):
+        raise DirectiveException(
+            "# followed by a non-identifier", directive_name_ident.span
+        )
+    name = directive_name_ident.identifier
+
+    with STATS.directive(name, hash_token.span.source):
+        execute_directive(start_key, directive_name_ident, tokens, ctx)
 
-        # TODO: Handle identifier for macro expansion
-        pass
 
+# Symbols of the directive names
+_DEFINE = SYMBOLS.intern("define")
+_UNDEF = SYMBOLS.intern("undef")
+_ERROR = SYMBOLS.intern("error")
+_INCLUDE = SYMBOLS.intern("include")
+_IF_GROUP = {SYMBOLS.intern(name) for name in ["if", "ifdef", "ifndef"]}
+_LINE = SYMBOLS.intern("line")
+_PRAGMA = SYMBOLS.intern("pragma")
 
-# Makes a separate subtokenizedctx for the "arguments" of the directive
+
+def execute_directive(
+    start_key: ElementKey,
+    directive_name_ident: Identifier,
+    tokens: TokenizedStream,
+    ctx: DirectiveExecutionContext,
+) -> None:
+    symbol = directive_name_ident.symbol
+
+    if symbol == _DEFINE:
+        preprocess_define(directive_name_ident, tokens, ctx)
+    elif symbol == _UNDEF:
+        preprocess_undef(directive_name_ident, tokens, ctx)
+    elif symbol == _ERROR:
+        preprocess_error(directive_name_ident, tokens, ctx)
+    elif symbol == _INCLUDE:
+        preprocess_include(start_key, directive_name_ident, tokens, ctx)
+    elif symbol in _IF_GROUP:
+        preprocess_if_group(directive_name_ident, tokens, ctx)
+    elif symbol == _LINE:
+        preprocess_line(directive_name_ident, tokens, ctx)
+    elif symbol == _PRAGMA:
+        preprocess_pragma(directive_name_ident, tokens, ctx)
+    else:
+        # TODO: Should you actually emit an error here?
+        # clang and gcc do, but the standard seems to say they should be ignored
+        raise DirectiveException(
+            f"Unknown directive {directive_name_ident.identifier}", directive_name_ident.span
+        )
+
+
+# Makes a separate subtokenizedctx for the "arguments" of the directive. It ends at the
+# next newline, or if whitespace was elided, before the first token of the next line
 def get_directive_tokens(tokens: TokenizedStream) -> TokenizedStream:
     start = tokens.idx
 
     while True:
         el = tokens.peek_element()
-        if isinstance(el, SpaceSequence) and el.has_nl or el is None:
+        if el is None or el.at_bol or isinstance(el, SpaceSequence) and el.has_nl:
             break
 
         tokens.pop_element()
@@ -193,6 +477,7 @@ def preprocess_define(
     if (
         isinstance(paren_or_space, Punctuator)
         and paren_or_space.ty == PunctuatorType.OPEN_PAREN
+        and not paren_or_space.space_before
     ):
         define_function_macro(name_token, args, ctx)
     else:
@@ -202,9 +487,9 @@ def preprocess_define(
 def define_object_macro(
     macro_name: Identifier, contents: TokenizedStream, ctx: DirectiveExecutionContext
 ) -> None:
-    name = macro_name.identifier
+    symbol = macro_name.symbol
 
-    if name in ctx.macros:
+    if ctx.macros.lookup(symbol, "define") is not None:
         # TODO: We need to check if this macro is identical to the old one
         raise DirectiveException("Object macro already defined", macro_name.span)
 
@@ -213,15 +498,16 @@ def define_object_macro(
         body.append(contents.pop_element())  # type: ignore # we know pop_element won't be None because we just checked in the loop condition
 
     macro = ObjectMacro(body)
-    ctx.macros[name] = macro
+    ctx.expander.replacement(macro)  # checks the uses of ##
+    ctx.macros[symbol] = macro
 
 
 def define_function_macro(
     macro_name: Identifier, contents: TokenizedStream, ctx: DirectiveExecutionContext
 ) -> None:
-    name = macro_name.identifier
+    symbol = macro_name.symbol
 
-    if name in ctx.macros:
+    if ctx.macros.lookup(symbol, "define") is not None:
         # TODO: We need to check if this macro is identical to the old one
         raise DirectiveException("Function macro already defined", macro_name.span)
 
@@ -283,7 +569,8 @@ def define_function_macro(
         body.append(contents.pop_element())  # type: ignore # we know pop_element won't be None because we just checked in the loop condition
 
     macro = FunctionMacro(parameters, has_varargs, body)
-    ctx.macros[name] = macro
+    ctx.expander.replacement(macro)  # checks the uses of # and ##
+    ctx.macros[symbol] = macro
 
 
 def preprocess_undef(
@@ -301,10 +588,10 @@ def preprocess_undef(
     if after is not None:
         raise DirectiveException("Expected newline", after.span)
 
-    macro_name = name_token.identifier
+    symbol = name_token.symbol
 
-    if macro_name in ctx.macros:
-        del ctx.macros[macro_name]
+    if ctx.macros.lookup(symbol, "undef") is not None:
+        del ctx.macros[symbol]
 
 
 def preprocess_error(
@@ -343,27 +630,42 @@ def preprocess_include(
     if after is not None:
         raise DirectiveException("Expected newline", after.span)
 
-    source: Optional[Source] = None
+    if STATS.enabled:
+        load_start = time.perf_counter()
 
     # C standard dictates `#include "xyz"` should act as `#include <xyz>` if "xyz" is not found.
-    if ctx.compilation_ctx.brain_rot_amount <= BrainRotAmount.REDUCED:
-        source = ctx.compilation_ctx.find_include_source(
-            header_name.name, not header_name.is_q
-        )
-    else:
-        if header_name.is_q:
-            source = ctx.compilation_ctx.find_include_source(header_name.name, False)
-        source = source or ctx.compilation_ctx.find_include_source(
-            header_name.name, True
-        )
+    source: Optional[Source] = None
+    for is_library in include_lookups(header_name, ctx):
+        source = ctx.compilation_ctx.find_include_source(header_name.name, is_library)
+        if source is not None:
+            break
 
     if source is None:
         raise DirectiveException(
             f"Failed to search for {header_name}", header_name.span
         )
 
-    included = TokenizedStream.tokenize(SourceStream(source, 0))
+    if isinstance(source.filename, str):
+        path = os.path.realpath(source.filename)
+        if path not in ctx.included_files:
+            ctx.included_files.append(path)
+
+    included = tokenize_source(source, ctx)
+    prefetch_includes(included, ctx)
+    included_count = len(included.entries) - 1  # not counting the EOF entry
     tokens.replace_range(start_key, tokens.idx, included)
+    # Continue at the start of the included file, so its directives are executed too
+    if included.idx != included.end:
+        tokens.idx = included.idx
+    tokens.push_directives(included)
+
+    if STATS.enabled:
+        STATS.record_include(
+            directive_name.span.source,
+            source,
+            included_count,
+            time.perf_counter() - load_start,
+        )
 
 
 def preprocess_if_group(
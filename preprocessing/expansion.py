@@ -0,0 +1,666 @@
+from __future__ import annotations
+from typing import (
+    Any, Dict, FrozenSet, Generator, List, Optional, Sequence, Tuple, TypeVar, Union, cast
+)
+import copy
+
+from span import Span, SourceStream, SOURCES
+from stats import STATS
+from .tokenizer.tokenize import LexicalElement, SpaceSequence, PPToken, TokenizeException
+from .tokenizer.identifier import Identifier
+from .tokenizer.punctuator import Punctuator, PunctuatorType
+from .tokenizer.string import StringLiteral, StringPrefix
+from .tokenizer.character import CharacterLiteral
+from .directives import (
+    DirectiveExecutionContext,
+    DirectiveException,
+    Macro,
+    FunctionMacro,
+)
+
+
+# An element waiting to be scanned, with the span of the top level macro invocation it
+# came from, or None if it's still where it was written. Pending elements are kept in a
+# list with the next one last
+Pending = Tuple[LexicalElement, Optional[Span]]
+
+# The arguments of an invocation, split at the top level commas, and those commas
+Arguments = Tuple[List[List[LexicalElement]], List[LexicalElement]]
+# Returned by _collect_arguments when the elements ran out before the argument list
+# started, or before it ended
+_NO_PAREN_YET: Arguments = ([], [])
+_UNTERMINATED: Arguments = ([], [])
+
+ExpansionKey = Tuple[Macro, Tuple[Tuple[str, ...], ...], FrozenSet[int]]
+
+# A step of the expansion, run by MacroExpander._run. When it needs the result of
+# another step, like the expansion of a macro it found, it yields that step and is sent
+# its result. What it returns is sent to the step that yielded it
+Step = Generator["Step", Any, Any]
+T = TypeVar("T")
+
+
+def spelling(el: LexicalElement) -> str:
+    return el.span.contents()
+
+
+# A copy of tok that is never expanded. Used for identifiers naming a macro that is
+# being expanded when they're read (6.10.3.4p2)
+def paint(tok: Identifier) -> Identifier:
+    painted = copy.copy(tok)
+    painted.painted = True
+    return painted
+
+
+# A copy of el with space before it. Under -felide-whitespace, a token taking the place
+# of one that had space before it, like the first token of an expansion, gets the flag
+# where the SpaceSequence would have been kept otherwise
+def with_space(el: LexicalElement) -> LexicalElement:
+    if el.space_before:
+        return el
+    spaced = copy.copy(el)
+    spaced.space_before = True
+    return spaced
+
+
+def is_punctuator(el: LexicalElement, ty: PunctuatorType) -> bool:
+    return isinstance(el, Punctuator) and el.ty == ty
+
+
+# The argument of a parameter as a string literal, for the # operator (6.10.3.2)
+def stringize(arg: List[LexicalElement]) -> str:
+    parts = ['"']
+    space = False
+    for el in arg:
+        if isinstance(el, SpaceSequence):
+            space = True
+            continue
+        if (space or el.space_before) and len(parts) > 1:
+            parts.append(" ")
+        space = False
+
+        text = spelling(el)
+        if isinstance(el, (StringLiteral, CharacterLiteral)):
+            text = text.replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(text)
+    parts.append('"')
+    return "".join(parts)
+
+
+def strip_spaces(elements: List[LexicalElement]) -> List[LexicalElement]:
+    start = 0
+    end = len(elements)
+    while start < end and isinstance(elements[start], SpaceSequence):
+        start += 1
+    while end > start and isinstance(elements[end - 1], SpaceSequence):
+        end -= 1
+    return elements[start:end]
+
+
+# #x in the replacement list of a function-like macro
+class Stringize:
+    def __init__(self, hash_token: LexicalElement, param: int) -> None:
+        self.hash_token = hash_token
+        self.param = param
+
+
+# a ## b ## ... in a replacement list. Each operand is a token, a parameter, whose
+# argument is used as written, or a stringized parameter
+class Paste:
+    def __init__(self, first: Union[LexicalElement, int, Stringize], op: LexicalElement) -> None:
+        self.operands = [first]
+        self.op = op  # the first ##, for errors
+
+
+Part = Union[LexicalElement, int, Stringize, Paste]
+
+
+# A replacement list with its operators and parameters picked out: tokens are copied,
+# parameters (by index) are replaced by their expanded argument, and operators are
+# applied to the arguments as written. So only the arguments of parameters that appear
+# on their own are ever expanded, and only once the substitution reaches them
+class Replacement:
+    def __init__(
+        self,
+        parts: Sequence[Part],
+        spaced: FrozenSet[int],
+        used: Tuple[int, ...],
+        expanded: Tuple[int, ...],
+        plain: bool,
+    ) -> None:
+        self.parts = parts
+        # The parts, by index, written with space_before on their first token
+        self.spaced = spaced
+        # The parameters the result depends on. The other arguments are ignored
+        self.used = used
+        # The parameters whose argument is substituted expanded
+        self.expanded = expanded
+        # Whether parts is the body as it is, with nothing to substitute
+        self.plain = plain
+
+
+# Finds the operators and parameters in the replacement list of macro. Raises
+# DirectiveException if they're used wrong
+def compile_replacement(macro: Macro) -> Replacement:
+    params: Dict[int, int] = {}
+    if isinstance(macro, FunctionMacro):
+        params = macro.parameter_index
+
+    parts: List[Union[LexicalElement, int, Stringize, Paste]] = []
+    spaced = set()
+    # The pending ## whose right operand hasn't been seen yet
+    paste: Optional[Paste] = None
+
+    body = macro.body
+    i = 0
+    while i < len(body):
+        el = body[i]
+        i += 1
+        part: Union[LexicalElement, int, Stringize] = el
+        if isinstance(el, SpaceSequence):
+            if paste is None:
+                parts.append(el)
+            continue
+
+        if is_punctuator(el, PunctuatorType.DOUBLE_HASH):
+            if paste is None:
+                while parts and isinstance(parts[-1], SpaceSequence):
+                    parts.pop()
+                if not parts:
+                    raise DirectiveException("'##' can't be at the start of a replacement list", el.span)
+                left = parts.pop()  # the paste takes its place, and so its index in spaced
+                if isinstance(left, Paste):  # a ## b ## c
+                    paste = left
+                else:
+                    paste = Paste(left, el)
+            continue
+
+        if isinstance(el, Identifier) and el.symbol in params:
+            part = params[el.symbol]
+        elif params and is_punctuator(el, PunctuatorType.HASH):
+            while i < len(body) and isinstance(body[i], SpaceSequence):
+                i += 1
+            param = body[i] if i < len(body) else None
+            if not isinstance(param, Identifier) or param.symbol not in params:
+                raise DirectiveException("'#' has to be followed by a parameter", el.span)
+            part = Stringize(el, params[param.symbol])
+            i += 1
+
+        if paste is not None:
+            paste.operands.append(part)
+            parts.append(paste)
+            paste = None
+        else:
+            if el.space_before:
+                spaced.add(len(parts))
+            parts.append(part)
+
+    if paste is not None:
+        raise DirectiveException("'##' can't be at the end of a replacement list", paste.op.span)
+
+    used = set()
+    expanded = set()
+    for compiled in parts:
+        if isinstance(compiled, int):
+            expanded.add(compiled)
+        for operand in compiled.operands if isinstance(compiled, Paste) else [compiled]:
+            if isinstance(operand, int):
+                used.add(operand)
+            elif isinstance(operand, Stringize):
+                used.add(operand.param)
+
+    if all(isinstance(part, LexicalElement) for part in parts):
+        return Replacement(body, frozenset(), (), (), True)
+    return Replacement(
+        parts, frozenset(spaced), tuple(sorted(used)), tuple(sorted(expanded)), False
+    )
+
+
+# The tokens made by # and ## during one substitution. Their spellings are collected,
+# added to the scratch source together and lexed from there once the substitution is
+# done, instead of one by one. Until then, the operator is a placeholder for each of them
+class Scratch:
+    def __init__(self) -> None:
+        self.texts: List[str] = []
+        self.slots: List[int] = []  # index of the placeholder in the output
+        self.is_string: List[bool] = []  # made by #, so known to be one string literal
+        self.space_before: List[bool] = []
+
+    def add(
+        self,
+        out: List[LexicalElement],
+        text: str,
+        op: LexicalElement,
+        is_string: bool,
+        space_before: bool,
+    ) -> None:
+        self.texts.append(text)
+        self.slots.append(len(out))
+        self.is_string.append(is_string)
+        self.space_before.append(space_before)
+        out.append(op)
+
+    def fill(self, out: List[LexicalElement]) -> None:
+        if not self.texts:
+            return
+        source, start = SOURCES.add_scratch("\n".join(self.texts))
+        STATS.count("scratch_tokens", len(self.texts))
+
+        for text, slot, is_string, space_before in zip(
+            self.texts, self.slots, self.is_string, self.space_before
+        ):
+            end = start + len(text)
+            tok: Optional[LexicalElement] = None
+            if is_string:
+                tok = StringLiteral(Span(source, start, end), StringPrefix.NONE)
+            else:
+                inp = SourceStream(source, start)
+                try:
+                    tok = PPToken.tokenize(inp)
+                except TokenizeException:
+                    pass
+                if inp.idx != end:
+                    tok = None
+            if tok is None:
+                raise DirectiveException(
+                    f"Pasting gives {text!r}, which isn't one preprocessing token", out[slot].span
+                )
+            if space_before:
+                tok.space_before = True
+            out[slot] = tok
+            start = end + 1
+
+
+# What the expansion of a macro depends on in its arguments
+def fingerprint(args: List[List[LexicalElement]]) -> Tuple[Tuple[str, ...], ...]:
+    return tuple(
+        tuple(
+            " " if isinstance(el, SpaceSequence)
+            else "\0" + el.identifier if isinstance(el, Identifier) and el.painted
+            else " " + spelling(el) if el.space_before
+            else spelling(el)
+            for el in arg
+        )
+        for arg in args
+    )
+
+
+# Expands the macros in the text between directives.
+# Every expansion is rescanned on its own, with the macros being expanded disabled. When
+# the result ends in the name of a function-like macro, the rest of the input could hold
+# its arguments, so that name and whatever follows it is the tail of the expansion, and
+# is rescanned together with the rest of the input instead.
+# Expansions outside of any other are cached by the macro and its arguments, as long as
+# the macro table isn't changed by #define or #undef.
+# Rescans and expansions of arguments nest inside each other as deep as the macros do.
+# They're run as steps on an explicit stack rather than by recursion, see _run
+class MacroExpander:
+    # Bounds the memory used by the cache
+    MAX_CACHED = 1 << 14
+    # Invocations with longer arguments than this, in tokens, are rarely repeated, and
+    # fingerprinting arguments nested inside each other would take quadratic time
+    MAX_CACHED_ARGUMENTS = 256
+
+    def __init__(self, ctx: DirectiveExecutionContext) -> None:
+        self.ctx = ctx
+
+        # (macro, fingerprint of the arguments, disabled macros) -> (result, tail)
+        self.cache: Dict[ExpansionKey, Tuple[List[LexicalElement], List[LexicalElement]]] = {}
+        self.generation = ctx.macros.generation  # of the macro table the cache is for
+
+        # Never goes stale, as a macro isn't changed once defined
+        self.replacements: Dict[Macro, Replacement] = {}
+
+        # Number of macro expansions in progress, at most max_depth unless that is 0
+        self.depth = 0
+        self.max_depth = ctx.compilation_ctx.max_macro_depth
+
+    def replacement(self, macro: Macro) -> Replacement:
+        replacement = self.replacements.get(macro)
+        if replacement is None:
+            replacement = self.replacements[macro] = compile_replacement(macro)
+        return replacement
+
+    # Expands elements, which have no directives in them. Returns the result, and for each
+    # element of it the span it should be reported at, or None if nothing was expanded
+    def expand_run(
+        self, elements: List[LexicalElement]
+    ) -> Optional[Tuple[List[LexicalElement], List[Span]]]:
+        macros = self.ctx.macros
+        for first, el in enumerate(elements):
+            if (
+                isinstance(el, Identifier)
+                and not el.painted
+                and macros.lookup(el.symbol, "expand") is not None
+            ):
+                break
+        else:
+            return None
+
+        out = elements[:first]
+        locations = [el.span for el in out]
+        pending: List[Pending] = [(el, None) for el in reversed(elements[first:])]
+        try:
+            self._run(self._scan(pending, frozenset(), out, locations, False))
+        finally:
+            self.depth = 0
+        return out, locations
+
+    # Runs step, and the steps it yields, to completion with a stack of steps in progress
+    # instead of Python's call stack, so how deep expansions can nest is only limited by
+    # memory (and max_depth). A DirectiveException is raised in the step that yielded the
+    # failing one, as a call would
+    def _run(self, step: Generator[Step, Any, T]) -> T:
+        stack: List[Step] = [step]
+        result: Any = None  # sent to the step on top of the stack
+        error: Optional[DirectiveException] = None
+        while True:
+            try:
+                if error is not None:
+                    called = stack[-1].throw(error)
+                    error = None
+                else:
+                    called = stack[-1].send(result)
+            except StopIteration as done:
+                stack.pop()
+                if not stack:
+                    # Returned by step itself
+                    return cast(T, done.value)
+                result = done.value
+                continue
+            except DirectiveException as e:
+                stack.pop()
+                if not stack:
+                    raise
+                error = e
+                continue
+            stack.append(called)
+            result = None
+
+    # Scans pending into out, expanding every macro that isn't disabled. If isolated,
+    # pending is all there is to the input, and the tail is returned when there is one.
+    # Otherwise the input ends with pending, and the tail is always empty
+    def _scan(
+        self,
+        pending: List[Pending],
+        disabled: FrozenSet[int],
+        out: List[LexicalElement],
+        locations: Optional[List[Span]],
+        isolated: bool,
+    ) -> Generator[Step, Any, List[LexicalElement]]:
+        macros = self.ctx.macros
+        # Whether the next token takes the place of an invocation with space before it,
+        # whose expansion was empty
+        space = False
+        while pending:
+            el, location = pending.pop()
+            if space:
+                el = with_space(el)
+                space = False
+            if isinstance(el, Identifier) and not el.painted:
+                symbol = el.symbol
+                if symbol in disabled:
+                    el = paint(el)
+                else:
+                    macro = macros.lookup(symbol, "expand")
+                    if macro is not None:
+                        args: Optional[Arguments] = None
+                        if isinstance(macro, FunctionMacro):
+                            args = self._collect_arguments(pending)
+                            if args is _NO_PAREN_YET or args is _UNTERMINATED:
+                                if isolated:
+                                    tail = [el] + [p[0] for p in reversed(pending)]
+                                    pending.clear()
+                                    return tail
+                                if args is _UNTERMINATED:
+                                    self._fail(
+                                        DirectiveException(
+                                            f"Unterminated argument list invoking {el.identifier}",
+                                            el.span,
+                                        ),
+                                        locations,
+                                    )
+                                    continue
+                                args = None
+
+                        if args is not None or not isinstance(macro, FunctionMacro):
+                            try:
+                                result, tail = yield self._expand(el, macro, args, disabled)
+                            except DirectiveException as e:
+                                self._fail(e, locations)
+                                continue
+                            location = location or el.span
+                            if el.space_before:
+                                if result:
+                                    result = [with_space(result[0])] + result[1:]
+                                else:
+                                    space = True
+                            out.extend(result)
+                            if locations is not None:
+                                locations.extend([location] * len(result))
+                            pending.extend((t, location) for t in reversed(tail))
+                            continue
+
+            out.append(el)
+            if locations is not None:
+                locations.append(location or el.span)
+        return []
+
+    # Handles an error in an invocation being scanned. Outside of any expansion (where
+    # locations are kept) it's recorded if errors are collected, and the invocation is
+    # dropped from the output. Otherwise it's raised
+    def _fail(self, error: DirectiveException, locations: Optional[List[Span]]) -> None:
+        diagnostics = self.ctx.diagnostics
+        if locations is None or diagnostics is None:
+            raise error
+        self.depth = 0
+        diagnostics.add("Directive expansion error", error.msg, error.span)
+
+    # Finds the argument list of a function-like macro at the top of pending, and pops it.
+    # None if the next token isn't an opening parenthesis
+    def _collect_arguments(self, pending: List[Pending]) -> Optional[Arguments]:
+        i = len(pending) - 1
+        while i >= 0 and isinstance(pending[i][0], SpaceSequence):
+            i -= 1
+        if i < 0:
+            return _NO_PAREN_YET
+        paren = pending[i][0]
+        if not isinstance(paren, Punctuator) or paren.ty != PunctuatorType.OPEN_PAREN:
+            return None
+
+        args: List[List[LexicalElement]] = [[]]
+        commas: List[LexicalElement] = []
+        depth = 0
+        for i in range(i - 1, -1, -1):
+            el = pending[i][0]
+            if isinstance(el, Punctuator):
+                if el.ty == PunctuatorType.OPEN_PAREN:
+                    depth += 1
+                elif el.ty == PunctuatorType.CLOSE_PAREN:
+                    if depth == 0:
+                        del pending[i:]
+                        return args, commas
+                    depth -= 1
+                elif el.ty == PunctuatorType.COMMA and depth == 0:
+                    commas.append(el)
+                    args.append([])
+                    continue
+            args[-1].append(el)
+        return _UNTERMINATED
+
+    # The arguments given for each parameter of macro, with the variable arguments joined
+    def _bind_arguments(
+        self, name_token: Identifier, macro: FunctionMacro, args: Arguments
+    ) -> List[List[LexicalElement]]:
+        values, commas = args
+        n = len(macro.parameters)
+        if macro.has_varargs:
+            if len(values) > n:
+                varargs = list(values[n])
+                for comma, value in zip(commas[n:], values[n + 1 :]):
+                    varargs.append(comma)
+                    varargs.extend(value)
+                values = values[:n] + [varargs]
+            elif len(values) == n:
+                values = values + [[]]
+        elif n == 0 and len(values) == 1 and all(isinstance(el, SpaceSequence) for el in values[0]):
+            values = []
+
+        expected = n + macro.has_varargs
+        if len(values) != expected:
+            raise DirectiveException(
+                f"{name_token.identifier} takes {n} argument{'s' * (n != 1)}"
+                f"{' or more' * macro.has_varargs}, but {len(values)} were given",
+                name_token.span,
+            )
+        return values
+
+    # Expands one invocation, args is None for an object-like macro. Returns the result
+    # and the tail
+    def _expand(
+        self,
+        name_token: Identifier,
+        macro: Macro,
+        args: Optional[Arguments],
+        disabled: FrozenSet[int],
+    ) -> Generator[Step, Any, Tuple[List[LexicalElement], List[LexicalElement]]]:
+        values: List[List[LexicalElement]] = []
+        if args is not None:
+            assert isinstance(macro, FunctionMacro)
+            values = self._bind_arguments(name_token, macro, args)
+
+        if self.generation != self.ctx.macros.generation or len(self.cache) >= self.MAX_CACHED:
+            self.cache.clear()
+            self.generation = self.ctx.macros.generation
+
+        replacement = self.replacement(macro)
+        # Nested invocations are part of the result of the outermost one, so only that is
+        # cached, saving the fingerprints of arguments passed down through many macros
+        key: Optional[ExpansionKey] = None
+        used = [values[i] for i in replacement.used]
+        if not disabled and sum(map(len, used)) <= self.MAX_CACHED_ARGUMENTS:
+            key = (macro, fingerprint(used), disabled)
+            cached = self.cache.get(key)
+            if cached is not None:
+                STATS.count("expansion_cache_hits")
+                return cached
+        STATS.count("macro_expansions")
+
+        if self.depth == self.max_depth and self.max_depth:
+            raise DirectiveException(
+                f"Macro expansions nested more than {self.max_depth} deep while expanding "
+                f"{name_token.identifier}. The limit is set with -fmax-macro-depth=<n>",
+                name_token.span,
+            )
+        self.depth += 1
+        STATS.maximum("max_macro_depth", self.depth)
+
+        body = macro.body
+        if not replacement.plain:
+            # Only the arguments substituted on their own are expanded, each once
+            expanded: Dict[int, List[LexicalElement]] = {}
+            for i in replacement.expanded:
+                expanded[i] = values[i]
+                if self._needs_expansion(values[i]):
+                    expanded[i] = yield self._expand_argument(values[i], disabled)
+            body = self._substitute(replacement, values, expanded)
+
+        out: List[LexicalElement] = []
+        pending: List[Pending] = [(el, None) for el in reversed(body)]
+        tail = yield self._scan(pending, disabled | {name_token.symbol}, out, None, True)
+        self.depth -= 1
+
+        if key is not None:
+            self.cache[key] = (out, tail)
+        return out, tail
+
+    # The replacement list with the arguments substituted and the operators applied.
+    # expanded holds the expanded arguments, by parameter
+    def _substitute(
+        self,
+        replacement: Replacement,
+        values: List[List[LexicalElement]],
+        expanded: Dict[int, List[LexicalElement]],
+    ) -> List[LexicalElement]:
+        out: List[LexicalElement] = []
+        scratch = Scratch()
+        # Whether the next token takes the place of one with space before it. An empty
+        # argument passes it on
+        space = False
+        for i, part in enumerate(replacement.parts):
+            space = space or i in replacement.spaced
+            if isinstance(part, LexicalElement):
+                out.append(with_space(part) if space else part)
+                space = False
+            elif isinstance(part, int):
+                arg = expanded[part]
+                if arg:
+                    out.append(with_space(arg[0]) if space else arg[0])
+                    out.extend(arg[1:])
+                    space = False
+            elif isinstance(part, Stringize):
+                scratch.add(out, stringize(values[part.param]), part.hash_token, True, space)
+                space = False
+            else:
+                space = self._paste(part, values, out, scratch, space)
+        scratch.fill(out)
+        return out
+
+    # Applies a chain of ## at once. Where an operand is an argument of several tokens,
+    # only its first and last are pasted; a chain of single tokens makes one token.
+    # space is whether the first token made has space before it. Returns whether the
+    # next one does, which is only when every operand was empty
+    def _paste(
+        self,
+        paste: Paste,
+        values: List[List[LexicalElement]],
+        out: List[LexicalElement],
+        scratch: Scratch,
+        space: bool,
+    ) -> bool:
+        joint: List[str] = []  # spellings making up the token being built
+        for operand in paste.operands:
+            items: List[Union[LexicalElement, str]]
+            if isinstance(operand, int):
+                items = list(strip_spaces(values[operand]))
+            elif isinstance(operand, Stringize):
+                items = [stringize(values[operand.param])]
+            else:
+                items = [operand]
+            if not items:  # a placemarker
+                continue
+
+            first = items[0]
+            joint.append(first if isinstance(first, str) else spelling(first))
+            if len(items) > 1:
+                scratch.add(out, "".join(joint), paste.op, False, space)
+                out.extend(item for item in items[1:-1] if isinstance(item, LexicalElement))
+                last = items[-1]
+                joint = [last if isinstance(last, str) else spelling(last)]
+                space = isinstance(last, LexicalElement) and last.space_before
+
+        if joint:
+            scratch.add(out, "".join(joint), paste.op, False, space)
+            space = False
+        return space
+
+    # Whether expanding arg could change it. An argument without macro names, like one that
+    # was already expanded by an outer macro, is used as it is
+    def _needs_expansion(self, arg: List[LexicalElement]) -> bool:
+        macros = self.ctx.macros
+        for el in arg:
+            if isinstance(el, Identifier) and not el.painted and el.symbol in macros:
+                STATS.count("arguments_expanded")
+                return True
+        STATS.count("arguments_unchanged")
+        return False
+
+    # An argument is expanded as if it were the rest of the file (6.10.3.1p1)
+    def _expand_argument(
+        self, arg: List[LexicalElement], disabled: FrozenSet[int]
+    ) -> Generator[Step, Any, List[LexicalElement]]:
+        out: List[LexicalElement] = []
+        pending: List[Pending] = [(el, None) for el in reversed(arg)]
+        tail = yield self._scan(pending, disabled, out, None, True)
+        out.extend(tail)
+        return out
@@ -0,0 +1,141 @@
+from __future__ import annotations
+from array import array
+from functools import partial
+from itertools import groupby
+from typing import Any, Dict, List, Tuple
+import ast
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+
+from .tokenizer.tokenize import LexicalElement
+from .token_buffer import (
+    KINDS,
+    AT_BOL,
+    SPACE_BEFORE,
+    FLAGS,
+    KEYWORD_TYPES,
+    PUNCTUATOR_TYPES,
+    STRING_PREFIXES,
+    CHARACTER_PREFIXES,
+    TokenBuffer,
+)
+
+
+# Token streams exported for analysis, as one .npy file per column and a JSON schema, so
+# they can be memory mapped with numpy.load(path, mmap_mode="r") or read_column below
+# without building an object per token. The columns, one entry per element:
+#   kind: index into the "kinds" of the schema
+#   flags: 1 for tokens at the beginning of a line, 2 for tokens with elided whitespace
+#       before them
+#   type: the keyword or punctuator type or literal prefix, by index into the lists of the
+#       schema. For identifiers the index into "strings", for header names that index
+#       times 2, plus 1 for "" names. 1 for whitespace with a newline in it
+#   file: index into the "files" of the schema
+#   start, end: offsets into the file as written, before line splices were removed
+#   line: 1-based line of start
+COLUMNS: List[Tuple[str, str]] = [
+    ("kind", "B"),
+    ("flags", "B"),
+    ("type", "i"),
+    ("file", "i"),
+    ("start", "i"),
+    ("end", "i"),
+    ("line", "i"),
+]
+SCHEMA_FILE = "schema.json"
+
+_NPY_MAGIC = b"\x93NUMPY\x01\x00"
+_BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+_DESCRS = {"B": "|u1", "i": _BYTE_ORDER + "i4"}
+
+# Split the kind byte of a TokenBuffer into the kind and flags columns
+_KIND_TABLE = bytes(kind & ~FLAGS for kind in range(256))
+_FLAGS_TABLE = bytes(bool(kind & AT_BOL) | bool(kind & SPACE_BEFORE) << 1 for kind in range(256))
+
+
+# Writes column as a version 1.0 .npy file. The header is padded so the data starts at a
+# multiple of 64 bytes, as numpy does
+def write_npy(path: str, column: "array[int]") -> None:
+    header = (
+        f"{{'descr': '{_DESCRS[column.typecode]}', 'fortran_order': False, "
+        f"'shape': ({len(column)},), }}"
+    )
+    unpadded = len(_NPY_MAGIC) + 2 + len(header) + 1
+    header += " " * (-unpadded % 64) + "\n"
+    with open(path, "wb") as npy_file:
+        npy_file.write(_NPY_MAGIC)
+        npy_file.write(struct.pack("<H", len(header)))
+        npy_file.write(header.encode("latin1"))
+        column.tofile(npy_file)
+
+
+# Memory maps a column written by write_npy. The view keeps the file mapped until it's
+# released
+def read_column(path: str) -> memoryview:
+    with open(path, "rb") as npy_file:
+        mapped = mmap.mmap(npy_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[: len(_NPY_MAGIC)] != _NPY_MAGIC:
+        raise ValueError(f"{path} is not a .npy file of version 1.0")
+    (header_len,) = struct.unpack_from("<H", mapped, len(_NPY_MAGIC))
+    data_start = len(_NPY_MAGIC) + 2 + header_len
+    header = ast.literal_eval(mapped[len(_NPY_MAGIC) + 2 : data_start].decode("latin1"))
+    for fmt, descr in _DESCRS.items():
+        if header["descr"] == descr:
+            return memoryview(mapped)[data_start:].cast(fmt)  # type: ignore # fmt is a valid format
+    raise ValueError(f"{path} has unsupported type {header['descr']}")
+
+
+# Writes the columns of elements, and the schema to read them with, to directory
+def export_tokens(elements: List[LexicalElement], directory: str) -> None:
+    buf = TokenBuffer.from_elements(elements)
+    n = len(buf)
+
+    kinds = array("B", bytes(buf.kinds).translate(_KIND_TABLE))
+    flags = array("B", bytes(buf.kinds).translate(_FLAGS_TABLE))
+    starts = array("i", buf.starts)
+    ends = array("i", buf.ends)
+    lines = array("i", bytes(4 * n))
+
+    # Elements come in runs read from the same source, which are mapped to the file as
+    # written a run at a time
+    i = 0
+    for source_id, run in groupby(buf.source_ids):
+        j = i + len(list(run))
+        source = buf.source(source_id)
+        if source.original is not source:
+            starts[i:j] = array("i", map(source.original_offset, starts[i:j]))
+            ends[i:j] = array("i", map(source.original_end, ends[i:j]))
+        line_of = partial(bisect.bisect_right, source.original.line_starts())
+        lines[i:j] = array("i", map(line_of, starts[i:j]))
+        i = j
+
+    columns: Dict[str, "array[int]"] = {
+        "kind": kinds,
+        "flags": flags,
+        "type": array("i", buf.payloads),
+        "file": array("i", buf.source_ids),
+        "start": starts,
+        "end": ends,
+        "line": lines,
+    }
+    schema: Dict[str, Any] = {
+        "count": n,
+        "columns": {name: _DESCRS[fmt] for name, fmt in COLUMNS},
+        "kinds": [cls.__name__ for cls in KINDS],
+        "keywords": [ty.name for ty in KEYWORD_TYPES],
+        "punctuators": [ty.name for ty in PUNCTUATOR_TYPES],
+        "string_prefixes": [prefix.name for prefix in STRING_PREFIXES],
+        "character_prefixes": [prefix.name for prefix in CHARACTER_PREFIXES],
+        "files": [filename for filename, _, _ in buf.sources],
+        "strings": buf.strings,
+    }
+
+    os.makedirs(directory, exist_ok=True)
+    for name, _ in COLUMNS:
+        write_npy(os.path.join(directory, f"{name}.npy"), columns[name])
+    with open(os.path.join(directory, SCHEMA_FILE), "w") as schema_file:
+        json.dump(schema, schema_file)
@@ -0,0 +1,186 @@
+from __future__ import annotations
+from typing import List, Optional, Protocol, Set, Sequence
+import queue
+import threading
+
+from span import Source, Span
+from .tokenizer.tokenize import LexicalElement, Other, PPToken
+from .tokenizer.punctuator import PunctuatorType
+from .tokenizer.string import StringPrefix
+
+
+class Writable(Protocol):
+    def write(self, data: str) -> int:
+        ...
+
+    def flush(self) -> None:
+        ...
+
+
+# Writes everything to several files, so identical outputs can share a writer
+class TeeFile:
+    def __init__(self, files: Sequence[Writable]) -> None:
+        self.files = files
+
+    def write(self, data: str) -> int:
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+    def flush(self) -> None:
+        for f in self.files:
+            f.flush()
+
+
+# Writes strings to a file from a background thread, so the file I/O overlaps with
+# preprocessing. Writes are batched into chunks of at least chunk_size characters
+class BackgroundWriter:
+    def __init__(self, out: Writable, chunk_size: int = 1 << 16, max_queued: int = 64) -> None:
+        self.out = out
+        self.chunk_size = chunk_size
+
+        self.pending: List[str] = []
+        self.pending_len = 0
+
+        self.queue: queue.Queue[Optional[str]] = queue.Queue(max_queued)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                continue  # keep draining, so write() never blocks forever
+            try:
+                self.out.write(chunk)
+            except BaseException as e:
+                self.error = e
+
+    def write(self, data: str) -> None:
+        self.pending.append(data)
+        self.pending_len += len(data)
+        if self.pending_len >= self.chunk_size:
+            self._flush_pending()
+
+    def _flush_pending(self) -> None:
+        if self.pending:
+            self.queue.put("".join(self.pending))
+            self.pending = []
+            self.pending_len = 0
+
+    # Waits for everything to be written. Raises the error of the writer thread, if any
+    def close(self) -> None:
+        self._flush_pending()
+        self.queue.put(None)
+        self.thread.join()
+        self.out.flush()
+        if self.error is not None:
+            raise self.error
+
+
+def _punctuator_prefixes() -> Set[str]:
+    prefixes = {"//", "/*"}  # would start a comment
+    for punct in PunctuatorType:
+        for spelling in punct.value:
+            for i in range(2, len(spelling) + 1):
+                prefixes.add(spelling[:i])
+    return prefixes
+
+
+PUNCTUATOR_PREFIXES = _punctuator_prefixes()
+LITERAL_PREFIXES = {prefix.value for prefix in StringPrefix if prefix.value}
+
+
+def _is_word_ch(ch: str) -> bool:
+    return ch.isalnum() or ch == "_" or ch == "\\" or ord(ch) >= 0x80
+
+
+# Whether writing next right after prev would lex differently from the two tokens
+def needs_space(prev: str, next: str) -> bool:
+    a = prev[-1]
+    b = next[0]
+
+    if _is_word_ch(a):
+        if _is_word_ch(b):
+            return True
+        if b in "'\"" and prev in LITERAL_PREFIXES:
+            return True
+        if prev[0].isdigit() or prev[0] == ".":  # pp-number
+            return b == "." or (a in "eEpP" and b in "+-")
+        return False
+
+    if a == "." and b.isdigit():
+        return True
+
+    return (prev + b) in PUNCTUATOR_PREFIXES
+
+
+# Produces the -E output from the tokens left after preprocessing. Original whitespace is
+# dropped; tokens are separated by a space only when needed to keep them from pasting,
+# and newlines or line markers are used to keep tokens on their original lines.
+class PreprocessedOutput:
+    # Up to this many newlines are written instead of a line marker
+    MAX_BLANK_LINES = 8
+
+    def __init__(self, writer: BackgroundWriter) -> None:
+        self.writer = writer
+
+        self.source: Optional[Source] = None
+        self.line = 0  # 1-based line the output is currently on
+        self.prev: Optional[str] = None  # spelling of the previous token on this line
+        self.prev_is_other = False
+
+    def _line_marker(self, source: Source, line: int) -> None:
+        if self.source is not None:
+            self.writer.write("\n")
+        self.writer.write(f'# {line} "{source.filename}"\n')
+        self.source = source
+        self.line = line
+        self.prev = None
+
+    # at is where tok is reported to be, if not at its own span, like the invocation of
+    # the macro it was expanded from
+    def write_token(self, tok: LexicalElement, at: Optional[Span] = None) -> None:
+        if at is None:
+            at = tok.span
+        source = at.source
+        line = source.coords_for_offset(at.start)[0] + 1
+        spelling = tok.span.contents()
+        if not spelling:
+            return
+
+        if source is not self.source or line < self.line:
+            self._line_marker(source, line)
+        elif line - self.line > self.MAX_BLANK_LINES:
+            self._line_marker(source, line)
+        elif line > self.line:
+            self.writer.write("\n" * (line - self.line))
+            self.line = line
+            self.prev = None
+
+        is_other = isinstance(tok, Other)
+        if self.prev is not None and (
+            is_other or self.prev_is_other or needs_space(self.prev, spelling)
+        ):
+            self.writer.write(" ")
+
+        self.writer.write(spelling)
+        self.line += spelling.count("\n")
+        self.prev = spelling
+        self.prev_is_other = is_other
+
+    # Writes the tokens among elements, each at the span in locations if given
+    def write_tokens(
+        self, elements: List[LexicalElement], locations: Optional[List[Span]] = None
+    ) -> None:
+        for i, el in enumerate(elements):
+            if isinstance(el, PPToken):
+                self.write_token(el, locations[i] if locations is not None else None)
+
+    def finish(self) -> None:
+        if self.source is not None:
+            self.writer.write("\n")
+        self.writer.close()
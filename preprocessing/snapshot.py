@@ -0,0 +1,163 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional
+import json
+import os
+import struct
+
+from span import SourceStream
+from compilation_ctx import CompilationCtx
+from stats import STATS
+from .tokenizer.tokenize import LexicalElement
+from .tokenizer.identifier import SYMBOLS
+from .tokenized_stream import TokenizedStream
+from .token_buffer import TokenBuffer
+from .directives import (
+    DirectiveExecutionContext,
+    Macro,
+    ObjectMacro,
+    FunctionMacro,
+    builtin_macros,
+    preprocess,
+)
+
+
+# Snapshots of the macro environment left by a prefix header, like a precompiled header.
+# Written by -emit-pch and restored by -include-pch.
+# Layout: MAGIC, the length of the metadata as a little-endian u64, the metadata as JSON,
+# then a TokenBuffer holding the bodies of every macro back to back
+MAGIC = b"STPCH\x01"
+_LENGTH = struct.Struct("<Q")
+
+
+class SnapshotError(Exception):
+    def __init__(self, msg: str, prefix_file: Optional[str] = None) -> None:
+        self.msg = msg
+        # The header the snapshot was made from, if known, so a stale snapshot can be rebuilt
+        self.prefix_file = prefix_file
+
+
+# Options that change the result of preprocessing the prefix header
+def _config(compilation_ctx: CompilationCtx) -> Dict[str, Any]:
+    return {
+        "include_paths": compilation_ctx.include_paths,
+        "library_paths": compilation_ctx.library_paths,
+        "predefined_macros": compilation_ctx.predefined_macros,
+        "brain_rot_amount": int(compilation_ctx.brain_rot_amount),
+    }
+
+
+def _dependency(path: str) -> List[Any]:
+    st = os.stat(path)
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+def save_snapshot(ctx: DirectiveExecutionContext, path: str, prefix_file: str) -> None:
+    builtins = builtin_macros()
+    macros: List[Dict[str, Any]] = []
+    bodies: List[LexicalElement] = []
+    for symbol, macro in ctx.macros.items():
+        name = SYMBOLS.name(symbol)
+        if name in builtins:  # made again by every DirectiveExecutionContext
+            continue
+        assert isinstance(macro, (ObjectMacro, FunctionMacro))
+        entry: Dict[str, Any] = {"name": name, "start": len(bodies), "count": len(macro.body)}
+        if isinstance(macro, FunctionMacro):
+            entry["parameters"] = macro.parameters
+            entry["has_varargs"] = macro.has_varargs
+        macros.append(entry)
+        bodies.extend(macro.body)
+
+    dependencies = [os.path.realpath(prefix_file)] + ctx.included_files
+    meta = json.dumps(
+        {
+            "config": _config(ctx.compilation_ctx),
+            "dependencies": [_dependency(dep) for dep in dependencies],
+            "included_files": ctx.included_files,
+            "line_nr_offset": ctx.line_nr_offset,
+            "macros": macros,
+        }
+    ).encode()
+
+    with STATS.phase("pch", {"file": path}):
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(MAGIC)
+            snapshot_file.write(_LENGTH.pack(len(meta)))
+            snapshot_file.write(meta)
+            snapshot_file.write(TokenBuffer.from_elements(bodies).to_bytes())
+
+
+# Adds the macros and included files of a snapshot to ctx. Raises SnapshotError if the
+# snapshot can't be read, was made with different options, or if one of the files it
+# was made from has changed since
+def load_snapshot(ctx: DirectiveExecutionContext, path: str) -> None:
+    with STATS.phase("pch", {"file": path}):
+        try:
+            with open(path, "rb") as snapshot_file:
+                data = snapshot_file.read()
+        except OSError as e:
+            raise SnapshotError(f"Can't read {path}: {e.strerror}")
+        if not data.startswith(MAGIC):
+            raise SnapshotError(f"{path} is not a snapshot")
+
+        meta_start = len(MAGIC) + _LENGTH.size
+        (meta_len,) = _LENGTH.unpack_from(data, len(MAGIC))
+        meta = json.loads(data[meta_start : meta_start + meta_len])
+        prefix_file = meta["dependencies"][0][0]
+
+        if meta["config"] != _config(ctx.compilation_ctx):
+            raise SnapshotError(f"{path} was made with different options", prefix_file)
+        for dependency in meta["dependencies"]:
+            try:
+                current = _dependency(dependency[0])
+            except OSError:
+                raise SnapshotError(f"{dependency[0]} was removed", prefix_file)
+            if current != dependency:
+                raise SnapshotError(f"{dependency[0]} has changed", prefix_file)
+
+        buf = TokenBuffer.decode(memoryview(data)[meta_start + meta_len :])
+        for entry in meta["macros"]:
+            body = list(buf.elements(entry["start"], entry["start"] + entry["count"]))
+            macro: Macro
+            if "parameters" in entry:
+                macro = FunctionMacro(entry["parameters"], entry["has_varargs"], body)
+            else:
+                macro = ObjectMacro(body)
+            ctx.macros[SYMBOLS.intern(entry["name"])] = macro
+
+        for included in meta["included_files"]:
+            if included not in ctx.included_files:
+                ctx.included_files.append(included)
+        ctx.line_nr_offset = meta["line_nr_offset"]
+    STATS.count("pch_macros_loaded", len(meta["macros"]))
+
+
+# Preprocesses prefix_file into ctx, as if it had been included, but without writing its
+# tokens to the output
+def preprocess_prefix(ctx: DirectiveExecutionContext, prefix_file: str) -> None:
+    source = ctx.compilation_ctx.file_source(prefix_file)
+    tokens = TokenizedStream.tokenize(
+        SourceStream(source, 0), ctx.diagnostics, ctx.compilation_ctx.elide_whitespace
+    )
+
+    output, ctx.output = ctx.output, None
+    try:
+        preprocess(tokens, ctx)
+    finally:
+        ctx.output = output
+
+
+# -include-pch. A snapshot that has gone stale is made again from its prefix header and
+# rewritten. Returns whether that happened
+def include_snapshot(ctx: DirectiveExecutionContext, path: str) -> bool:
+    try:
+        load_snapshot(ctx, path)
+        return False
+    except SnapshotError as e:
+        if e.prefix_file is None:
+            raise
+        prefix_file = e.prefix_file
+
+    STATS.count("pch_rebuilt")
+    preprocess_prefix(ctx, prefix_file)
+    save_snapshot(ctx, path, prefix_file)
+    return True
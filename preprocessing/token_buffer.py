@@ -0,0 +1,286 @@
+from __future__ import annotations
+from array import array
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type
+import json
+import os
+import struct
+
+from span import Span, Source, PseudoFilename, SOURCES
+from .tokenized_stream import TokenizedStream
+from .tokenizer.tokenize import LexicalElement, SpaceSequence, Other
+from .tokenizer.comment import Comment
+from .tokenizer.identifier import Identifier, Keyword, KeywordType
+from .tokenizer.number import PPNumber
+from .tokenizer.punctuator import Punctuator, PunctuatorType
+from .tokenizer.string import StringLiteral, StringPrefix
+from .tokenizer.character import CharacterLiteral, CharacterPrefix
+from .tokenizer.header_name import HeaderName
+from .tokenizer.phases import translate_phases_1_2
+
+
+KEYWORD_TYPES = list(KeywordType)
+PUNCTUATOR_TYPES = list(PunctuatorType)
+STRING_PREFIXES = list(StringPrefix)
+CHARACTER_PREFIXES = list(CharacterPrefix)
+
+# The kind column is the index of the element's class in KINDS. The payload column holds
+# whatever else is needed to rebuild the element, either inline or as an index into the
+# string table. The top bit of the kind is set for tokens at the beginning of a line, and
+# the next one for tokens with elided whitespace before them
+KINDS: List[Type[LexicalElement]] = [
+    SpaceSequence,
+    Comment,
+    Other,
+    Identifier,
+    Keyword,
+    PPNumber,
+    Punctuator,
+    StringLiteral,
+    CharacterLiteral,
+    HeaderName,
+]
+_KIND_OF: Dict[type, int] = {cls: kind for kind, cls in enumerate(KINDS)}
+_KEYWORD_INDEX = {ty: i for i, ty in enumerate(KEYWORD_TYPES)}
+_PUNCTUATOR_INDEX = {ty: i for i, ty in enumerate(PUNCTUATOR_TYPES)}
+AT_BOL = 0x80
+SPACE_BEFORE = 0x40
+FLAGS = AT_BOL | SPACE_BEFORE
+
+
+# Magic, format version, token count, length of the metadata
+_HEADER = struct.Struct("<4sIII")
+_MAGIC = b"STKB"
+_VERSION = 3
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+# A flat, columnar encoding of a token stream, made to be shared between processes
+# without pickling every element. Offsets are relative to the text the tokenizer read,
+# which is rebuilt from the original text of each file when the buffer is decoded.
+# The columns are native-endian int32 (the kind is a byte), as the buffer is only meant
+# to be shared on one machine. A decoded buffer reads its columns straight out of the
+# shared memory, and elements are only built when asked for
+class TokenBuffer:
+    def __init__(
+        self,
+        kinds: Sequence[int],
+        starts: Sequence[int],
+        ends: Sequence[int],
+        source_ids: Sequence[int],
+        payloads: Sequence[int],
+        sources: List[Tuple[str, bool, str]],  # (filename, is pseudo filename, original text)
+        strings: List[str],
+    ) -> None:
+        self.kinds = kinds
+        self.starts = starts
+        self.ends = ends
+        self.source_ids = source_ids
+        self.payloads = payloads
+        self.sources = sources
+        self.strings = strings
+
+        self._meta: Optional[bytes] = None
+        self._materialized_sources: Dict[int, Source] = {}
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    @staticmethod
+    def encode(stream: TokenizedStream) -> TokenBuffer:
+        return TokenBuffer.from_elements(stream.collect())
+
+    @staticmethod
+    def from_elements(elements: List[LexicalElement]) -> TokenBuffer:
+        kinds = array("B")
+        starts = array("i")
+        ends = array("i")
+        source_ids = array("i")
+        payloads = array("i")
+
+        sources: List[Tuple[str, bool, str]] = []
+        source_index: Dict[int, int] = {}
+        strings: List[str] = []
+        string_index: Dict[str, int] = {}
+
+        def intern(s: str) -> int:
+            idx = string_index.get(s)
+            if idx is None:
+                idx = string_index[s] = len(strings)
+                strings.append(s)
+            return idx
+
+        # The source the tokenizer read the last element from, by its global offsets. Runs
+        # of elements from the same source skip the lookup
+        base = end = -1
+        source_id = 0
+        for el in elements:
+            cls = el.__class__
+            kind = _KIND_OF.get(cls)
+            if kind is None:
+                raise TypeError(f"Can't encode {cls.__name__} in a TokenBuffer")
+
+            span = el.span
+            if not base <= span.lo <= end:
+                read = SOURCES.source_at(span.lo)
+                base, end = read.base, read.base + len(read.contents)
+                source_id = source_index.get(id(read), -1)
+                if source_id < 0:
+                    original = read.original
+                    source_id = source_index[id(read)] = len(sources)
+                    if isinstance(original.filename, PseudoFilename):
+                        sources.append((original.filename.value, True, original.contents))
+                    else:
+                        sources.append((original.filename, False, original.contents))
+
+            if el.at_bol:
+                kind |= AT_BOL
+            if el.space_before:
+                kind |= SPACE_BEFORE
+            kinds.append(kind)
+            starts.append(span.lo - base)
+            ends.append(span.hi - base)
+            source_ids.append(source_id)
+            payloads.append(_PAYLOADS[cls](el, intern))
+
+        return TokenBuffer(kinds, starts, ends, source_ids, payloads, sources, strings)
+
+    def _metadata(self) -> bytes:
+        if self._meta is None:
+            self._meta = json.dumps({"sources": self.sources, "strings": self.strings}).encode()
+        return self._meta
+
+    # (offset, size, format) of each column, in the order written
+    @staticmethod
+    def _layout(n: int, meta_len: int) -> List[Tuple[int, int, str]]:
+        offset = _align(_HEADER.size + meta_len)
+        layout = []
+        for fmt in "iiiiB":
+            size = n * struct.calcsize(fmt)
+            layout.append((offset, size, fmt))
+            offset = _align(offset + size)
+        return layout
+
+    def nbytes(self) -> int:
+        offset, size, _ = self._layout(len(self), len(self._metadata()))[-1]
+        return offset + size
+
+    def write_into(self, buf: memoryview) -> None:
+        meta = self._metadata()
+        _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, len(self), len(meta))
+        buf[_HEADER.size : _HEADER.size + len(meta)] = meta
+
+        columns = [self.starts, self.ends, self.source_ids, self.payloads, self.kinds]
+        for (offset, size, fmt), column in zip(self._layout(len(self), len(meta)), columns):
+            buf[offset : offset + size] = array(fmt, column).tobytes()
+
+    def to_bytes(self) -> bytes:
+        buf = bytearray(self.nbytes())
+        self.write_into(memoryview(buf))
+        return bytes(buf)
+
+    # Reads the columns from buf without copying them. buf has to outlive the buffer,
+    # or release() has to be called first
+    @staticmethod
+    def decode(buf: memoryview) -> TokenBuffer:
+        magic, version, n, meta_len = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("Not a token buffer")
+
+        meta = json.loads(bytes(buf[_HEADER.size : _HEADER.size + meta_len]))
+        layout = TokenBuffer._layout(n, meta_len)
+        starts, ends, source_ids, payloads, kinds = [
+            buf[offset : offset + size].cast(fmt)  # type: ignore # fmt is a valid format
+            for offset, size, fmt in layout
+        ]
+        sources = [(filename, is_pseudo, text) for filename, is_pseudo, text in meta["sources"]]
+        return TokenBuffer(kinds, starts, ends, source_ids, payloads, sources, meta["strings"])
+
+    # Copies the buffer into a new shared memory block. The caller owns the block, and has
+    # to close and unlink it
+    def share(self, name: Optional[str] = None) -> SharedMemory:
+        shm = SharedMemory(name, create=True, size=self.nbytes())
+        assert shm.buf is not None
+        self.write_into(shm.buf)
+        return shm
+
+    # Attaches to a block made by share(). Call release() before closing the block
+    @staticmethod
+    def attach(name: str) -> Tuple[TokenBuffer, SharedMemory]:
+        shm = SharedMemory(name)
+        assert shm.buf is not None
+        return TokenBuffer.decode(shm.buf), shm
+
+    def release(self) -> None:
+        for column in [self.kinds, self.starts, self.ends, self.source_ids, self.payloads]:
+            if isinstance(column, memoryview):
+                column.release()
+
+    # The source the tokens of source_id were read from in this process. Files are
+    # looked up in SOURCES first, so a header that was already loaded isn't registered
+    # twice
+    def source(self, source_id: int) -> Source:
+        source = self._materialized_sources.get(source_id)
+        if source is None:
+            filename, is_pseudo, text = self.sources[source_id]
+            original = None
+            if not is_pseudo:
+                original = SOURCES.find_file(os.path.realpath(filename))
+            if original is None or original.contents != text:
+                original = Source(PseudoFilename(filename) if is_pseudo else filename, text)
+            source = self._materialized_sources[source_id] = translate_phases_1_2(original)
+        return source
+
+    def element(self, i: int) -> LexicalElement:
+        kind = self.kinds[i]
+        span = Span(self.source(self.source_ids[i]), self.starts[i], self.ends[i])
+        el: LexicalElement = _BUILDERS[KINDS[kind & ~FLAGS]](self, span, self.payloads[i])
+        if kind & AT_BOL:
+            el.at_bol = True
+        if kind & SPACE_BEFORE:
+            el.space_before = True
+        return el
+
+    def elements(self, start: int = 0, stop: Optional[int] = None) -> Iterator[LexicalElement]:
+        for i in range(start, len(self) if stop is None else stop):
+            yield self.element(i)
+
+    def to_stream(self) -> TokenizedStream:
+        return TokenizedStream.from_list(list(self.elements()))
+
+
+_BUILDERS: Dict[type, Callable[[TokenBuffer, Span, int], Any]] = {
+    SpaceSequence: lambda buf, span, payload: SpaceSequence(span, bool(payload)),
+    Comment: lambda buf, span, payload: Comment(span),
+    Other: lambda buf, span, payload: Other(span),
+    Identifier: lambda buf, span, payload: Identifier(span, buf.strings[payload]),
+    Keyword: lambda buf, span, payload: Keyword(span, KEYWORD_TYPES[payload]),
+    PPNumber: lambda buf, span, payload: PPNumber(span),
+    Punctuator: lambda buf, span, payload: Punctuator(span, PUNCTUATOR_TYPES[payload]),
+    StringLiteral: lambda buf, span, payload: StringLiteral(span, STRING_PREFIXES[payload]),
+    CharacterLiteral: lambda buf, span, payload: CharacterLiteral(
+        span, CHARACTER_PREFIXES[payload]
+    ),
+    HeaderName: lambda buf, span, payload: HeaderName(
+        span, buf.strings[payload >> 1], bool(payload & 1)
+    ),
+}
+
+
+# The payload of an element, by its class. The second argument interns a string in the
+# string table
+_PAYLOADS: Dict[type, Callable[[Any, Callable[[str], int]], int]] = {
+    SpaceSequence: lambda el, intern: int(el.has_nl),
+    Comment: lambda el, intern: 0,
+    Other: lambda el, intern: 0,
+    Identifier: lambda el, intern: intern(el.identifier),
+    Keyword: lambda el, intern: _KEYWORD_INDEX[el.ty],
+    PPNumber: lambda el, intern: 0,
+    Punctuator: lambda el, intern: _PUNCTUATOR_INDEX[el.ty],
+    StringLiteral: lambda el, intern: STRING_PREFIXES.index(el.prefix),
+    CharacterLiteral: lambda el, intern: CHARACTER_PREFIXES.index(el.prefix),
+    HeaderName: lambda el, intern: intern(el.name) << 1 | el.is_q,
+}
@@ -1,14 +1,20 @@
 from __future__ import annotations
-from typing import List, Optional, NewType, Dict, Tuple
+from typing import Iterator, List, Optional, NewType, Dict, Tuple
 import random
 
 from span import Span, SourceStream, Source, PseudoFilename
+from stats import STATS
+from diagnostics import Diagnostics
 from .tokenizer.tokenize import (
     TokenizeException,
     PPToken,
     ProperPPToken,
     LexicalElement,
+    Other,
+    SpaceSequence,
 )
+from .tokenizer.punctuator import Punctuator, PunctuatorType
+from .tokenizer.phases import translate_phases_1_2
 
 
 class _EOFElement(LexicalElement):
@@ -33,6 +39,16 @@ def make_key() -> ElementKey:
 # the first member of the list that is not part of the ctx
 
 
+# Shared by the EOF sentinels of every stream, rather than registering a new empty Source
+# per stream
+NULL_SOURCE = Source(PseudoFilename.NULL, "")
+
+
+# Whether el is the # of a directive: a # that is the first token on its line
+def starts_directive(el: LexicalElement) -> bool:
+    return el.at_bol and isinstance(el, Punctuator) and el.ty == PunctuatorType.HASH
+
+
 class Entry:
     def __init__(self, element: LexicalElement, previous: ElementKey, next: ElementKey):
         self.element = element
@@ -41,8 +57,12 @@ class Entry:
 
 
 class TokenizedStream:
+    # directive_indices are the indices of the elements that start directives, if the
+    # caller already knows them
     @staticmethod
-    def from_list(elements: List[LexicalElement]) -> TokenizedStream:
+    def from_list(
+        elements: List[LexicalElement], directive_indices: Optional[List[int]] = None
+    ) -> TokenizedStream:
         element_list: Dict[ElementKey, Entry] = dict()
 
         idx2key = [make_key() for _ in range(len(elements) + 1)]
@@ -52,7 +72,7 @@ class TokenizedStream:
         last = idx2key[len(elements) - 1]
         end = idx2key[len(elements)]
 
-        nullSpan = Span(Source(PseudoFilename.NULL, ""), 0, 0)
+        nullSpan = Span(NULL_SOURCE, 0, 0)
         element_list[end] = Entry(_EOFElement(nullSpan), last, first)
 
         for i, e in enumerate(elements):
@@ -61,10 +81,14 @@ class TokenizedStream:
 
             element_list[idx2key[i]] = Entry(e, idx2key[i - 1], idx2key[i + 1])
 
+        if directive_indices is None:
+            directive_indices = [i for i, e in enumerate(elements) if starts_directive(e)]
+
         return TokenizedStream(
             element_list,
             first,
             end,
+            [idx2key[i] for i in directive_indices],
         )
 
     def __init__(
@@ -72,12 +96,19 @@ class TokenizedStream:
         element_list: Dict[ElementKey, Entry],  # {id: (token, from, to)}
         idx: ElementKey,
         end: ElementKey,
+        directives: Optional[List[ElementKey]] = None,
     ) -> None:
 
         self.entries = element_list
         self.idx = idx
         self.end = end  # Reference to the first element outisde the list
 
+        # Keys of the # of every directive, in order
+        self.directives = directives if directives is not None else []
+        # The directives not yet visited by next_directive. Streams spliced in at the
+        # cursor push their own directives, which come before the rest
+        self.pending_directives: List[Iterator[ElementKey]] = [iter(self.directives)]
+
     def collect(self) -> List[LexicalElement]:
         out = []
 
@@ -97,10 +128,20 @@ class TokenizedStream:
 
     # start is inclusive, end is not. invalidates data
     def replace_range(self, start: ElementKey, end: ElementKey, data: TokenizedStream) -> None:
+        with STATS.phase("splice"):
+            self._replace_range(start, end, data)
+
+    def _replace_range(self, start: ElementKey, end: ElementKey, data: TokenizedStream) -> None:
 
         before_start = self.entries[start].previous
         before_end = self.entries[end].previous
 
+        if data.idx == data.end:  # nothing to insert
+            self.entries[before_start].next = end
+            self.entries[end].previous = before_start
+            self._delete_range(start, end)
+            return
+
         before_data_end = data.entries[data.end].previous
 
         to_add = data.idx
@@ -115,6 +156,9 @@ class TokenizedStream:
         self.entries[before_data_end].next = end
         self.entries[end].previous = before_data_end
 
+        self._delete_range(start, end)
+
+    def _delete_range(self, start: ElementKey, end: ElementKey) -> None:
         to_delete = start
         while to_delete != end:
             next = self.entries[to_delete].next
@@ -128,7 +172,7 @@ class TokenizedStream:
             last_id = self.entries[self.end].previous
             last_span = self.entries[last_id].element.span
 
-            return Span(last_span.source, last_span.end, last_span.end)
+            return Span.from_offsets(last_span.hi, last_span.hi)
 
         return self.entries[self.idx].element.span
 
@@ -182,31 +226,120 @@ class TokenizedStream:
 
         return None
 
+    # The key of the next directive's #, or None if there are no more
+    def next_directive(self) -> Optional[ElementKey]:
+        while self.pending_directives:
+            key = next(self.pending_directives[-1], None)
+            if key is None:
+                self.pending_directives.pop()
+            elif key in self.entries:  # not removed by a splice
+                return key
+        return None
+
+    # Visits the directives of data, which was just spliced in at the cursor, before the
+    # remaining directives of this stream
+    def push_directives(self, data: TokenizedStream) -> None:
+        self.pending_directives.append(iter(data.directives))
+
+    # Moves the cursor to until, returning the elements passed over
+    def pop_elements_until(self, until: ElementKey) -> List[LexicalElement]:
+        out: List[LexicalElement] = []
+        idx = self.idx
+        while idx != until:
+            entry = self.entries[idx]
+            out.append(entry.element)
+            idx = entry.next
+        self.idx = until
+        return out
+
+    # If diagnostics is given, errors are recorded there and the rest of the offending
+    # line becomes an Other token. Otherwise TokenizeException is raised.
+    # A stream at the start of a file is tokenized after translation phases 1 and 2.
+    # With elide_whitespace, whitespace and comments are dropped, and only recorded by the
+    # at_bol and space_before flags of the token after them
+    @staticmethod
+    def tokenize(
+        inp: SourceStream, diagnostics: Optional[Diagnostics] = None, elide_whitespace: bool = False
+    ) -> TokenizedStream:
+        if inp.idx == 0:
+            inp = SourceStream(translate_phases_1_2(inp.source), 0)
+
+        with STATS.phase("tokenize"):
+            stream = TokenizedStream._tokenize(inp, diagnostics, elide_whitespace)
+
+        if STATS.enabled:
+            STATS.count("tokenized_files")
+            idx = stream.idx
+            while idx != stream.end:
+                el = stream.entries[idx].element
+                STATS.count_token(el.__class__.__name__, el.span.end - el.span.start)
+                idx = stream.entries[idx].next
+
+        return stream
+
     @staticmethod
-    def tokenize(inp: SourceStream) -> TokenizedStream:
+    def _tokenize(
+        inp: SourceStream, diagnostics: Optional[Diagnostics], elide_whitespace: bool
+    ) -> TokenizedStream:
         from .tokenizer.header_name import HeaderName
 
         elements: List[LexicalElement] = []
+        directive_indices: List[int] = []
+        at_bol = True
+        space_before = False
+        elided = 0
 
         last_token = None
         second_last_token = None
 
         while True:
             tok: Optional[LexicalElement] = None
-            if len(elements) >= 2 and HeaderName.is_valid(
-                inp, last_token, second_last_token
-            ):
-                tok = HeaderName.tokenize(inp)
-            elif LexicalElement.is_valid(inp):
-                tok = LexicalElement.tokenize(inp)
-            else:
-                break
+            start = inp.idx
+            try:
+                if len(elements) >= 2 and HeaderName.is_valid(
+                    inp, last_token, second_last_token
+                ):
+                    tok = HeaderName.tokenize(inp)
+                elif LexicalElement.is_valid(inp):
+                    tok = LexicalElement.tokenize(inp)
+                else:
+                    break
+            except TokenizeException as e:
+                if diagnostics is None:
+                    raise
+                diagnostics.add("Tokenization error", e.msg, e.span)
+
+                contents = inp.source.contents
+                end = contents.find("\n", start)
+                if end == -1:
+                    end = len(contents)
+                inp.idx = max(end, start + 1)
+                tok = Other(Span(inp.source, start, inp.idx))
+            if isinstance(tok, SpaceSequence):
+                at_bol = at_bol or tok.has_nl
+                if elide_whitespace:
+                    space_before = True
+                    elided += 1
+                    continue
+                elements.append(tok)
+                continue
+
             elements.append(tok)
+            if space_before:
+                tok.space_before = True
+                space_before = False
+            if at_bol:
+                tok.at_bol = True
+                if starts_directive(tok):
+                    directive_indices.append(len(elements) - 1)
+                at_bol = False
             if isinstance(tok, ProperPPToken):
                 second_last_token = last_token
                 last_token = tok
 
-        return TokenizedStream.from_list(elements)
+        if elide_whitespace:
+            STATS.count("elided_elements", elided)
+        return TokenizedStream.from_list(elements, directive_indices)
 
 # Renders stream into a graphviz object
 def render_stream(stream: TokenizedStream) -> None:
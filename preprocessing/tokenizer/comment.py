@@ -1,7 +1,7 @@
 from __future__ import annotations
 from typing import Optional
 
-from .tokenize import LexicalElement, TokenizeException, SpaceSequence, SpaceSequence
+from .tokenize import LexicalElement, TokenizeException, SpaceSequence
 from span import Span, SourceStream
 
 
@@ -12,30 +12,22 @@ class Comment(SpaceSequence):
     @staticmethod
     def tokenize(inp: SourceStream) -> Comment:
         start = inp.idx
+        contents = inp.source.contents
+
         if inp.peek_exact("//"):
-            inp.pop(2)
-            while True:
-                if inp.peek_exact("\n"):
-                    break
-                if SpaceSequence.is_valid(inp):
-                    SpaceSequence.tokenize(inp)
-                    continue
-                elif inp.peek(1) == None:
-                    break
-                else:
-                    inp.pop()
+            # Line splices have already been removed, so this runs to the next newline
+            nl = contents.find("\n", start + 2)
+            inp.idx = len(contents) if nl == -1 else nl
             return Comment(Span(inp.source, start, inp.idx))
 
         if inp.peek_exact("/*"):
-            inp.pop(2)
-            while True:
-                if inp.pop_exact("*/") != None:
-                    break
-                if inp.peek() == None:
-                    raise TokenizeException(
-                        "File ended in comment", Span(inp.source, start, inp.idx)
-                    )
-                inp.pop()
+            end = contents.find("*/", start + 2)
+            if end == -1:
+                inp.idx = len(contents)
+                raise TokenizeException(
+                    "File ended in comment", Span(inp.source, start, inp.idx)
+                )
+            inp.idx = end + 2
             return Comment(Span(inp.source, start, inp.idx))
         raise TokenizeException("Expected comment", inp.point_span())
 
@@ -1,6 +1,8 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 from enum import Enum
+from typing import Dict, Match
+import re
 
 from .tokenize import LexicalElement, TokenizeException, expect
 from span import Span, SourceStream
@@ -63,6 +65,11 @@ class SimpleEscape(Enum):
     CARRIAGE_RETURN = ("r", "\r")
     HORIZONTAL_TAB = ("t", "\t")
     VERTICAL_TAB = ("v", "\v")
+    BACKSLASH = ("\\", "\\")
+
+
+# Character after the backslash -> escape
+SIMPLE_ESCAPES: Dict[str, SimpleEscape] = {esc.value[0]: esc for esc in SimpleEscape}
 
 
 class SimpleEscapeSequence(EscapeSequence):
@@ -74,22 +81,17 @@ class SimpleEscapeSequence(EscapeSequence):
     @staticmethod
     def tokenize(inp: SourceStream) -> SimpleEscapeSequence:
         backslash = expect("\\", inp)
-        for esc in SimpleEscape:
-            if inp.peek_exact(esc.value[0]):
-                seq = expect(esc.value[0], inp)
-
-                return SimpleEscapeSequence(backslash.combine(seq), esc)
+        esc = SIMPLE_ESCAPES.get(inp.peek(1) or "")
+        if esc is None:
+            raise TokenizeException("Expected simple escape sequence", backslash)
 
-        raise TokenizeException("Expected simple escape sequence", backslash)
+        seq = expect(esc.value[0], inp)
+        return SimpleEscapeSequence(backslash.combine(seq), esc)
 
     @staticmethod
     def is_valid(inp: SourceStream) -> bool:
-        if inp.peek(1) != "\\":
-            return False
-        for esc in SimpleEscape:
-            if inp.peek_exact("\\" + esc.value[0]):
-                return True
-        return False
+        pair = inp.peek(2)
+        return pair is not None and pair[0] == "\\" and pair[1] in SIMPLE_ESCAPES
 
     def unescape(self) -> str:
         return self.esc.value[1]
@@ -123,3 +125,60 @@ class HexEscapeSequence(EscapeSequence):
 
     def unescape(self) -> str:
         return chr(self.value)
+
+
+_HEX_DIGITS = re.compile(r"[0-9a-fA-F]+")
+_ESCAPE = re.compile(r"\\(x[0-9a-fA-F]+|.)", re.DOTALL)
+_QUOTE_OR_BACKSLASH = {
+    '"': re.compile(r'["\\]'),
+    "'": re.compile(r"['\\]"),
+}
+
+
+# Moves inp past the body and closing quote of a string or character literal, starting
+# right after the opening quote. Escapes are only validated here, see unescape
+def scan_quoted(inp: SourceStream, quote: str) -> None:
+    contents = inp.source.contents
+    special = _QUOTE_OR_BACKSLASH[quote]
+    pos = inp.idx
+
+    while True:
+        m = special.search(contents, pos)
+        if m is None:
+            inp.idx = len(contents)
+            raise TokenizeException("EOF in string literal", inp.point_span())
+
+        pos = m.start()
+        if contents[pos] == quote:
+            inp.idx = pos + 1
+            return
+
+        after = contents[pos + 1 : pos + 2]
+        if after in SIMPLE_ESCAPES:
+            pos += 2
+        elif after == "x":
+            digits = _HEX_DIGITS.match(contents, pos + 2)
+            if digits is None:
+                inp.idx = pos + 2
+                raise TokenizeException(
+                    "Expected hexadecimal digit",
+                    Span(inp.source, pos + 2, min(pos + 3, len(contents))),
+                )
+            pos = digits.end()
+        else:
+            inp.idx = pos
+            raise TokenizeException("Expected escape code", inp.point_span())
+
+
+def _unescape_match(m: Match[str]) -> str:
+    code = m.group(1)
+    if code[0] == "x" and len(code) > 1:
+        return chr(int(code[1:], 16))
+    return SIMPLE_ESCAPES[code].value[1]
+
+
+# Decodes the escape sequences of a literal body already checked by scan_quoted
+def unescape(raw: str) -> str:
+    if "\\" not in raw:
+        return raw
+    return _ESCAPE.sub(_unescape_match, raw)
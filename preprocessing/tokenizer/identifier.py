@@ -1,5 +1,7 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, Dict, List
+from functools import lru_cache
+import re
 import unicodedata
 from enum import Enum
 
@@ -55,6 +57,9 @@ class KeywordType(Enum):
     THREAD_LOCAL = "_Thread_local"
 
 
+KEYWORDS: Dict[str, KeywordType] = {kw.value: kw for kw in KeywordType}
+
+
 class UniversalCharacterName(LexicalElement):
     def __init__(self, span: Span, value: int):
         super().__init__(span)
@@ -91,31 +96,76 @@ class UniversalCharacterName(LexicalElement):
         return inp.peek_exact("\\u") or inp.peek_exact("\\U")
 
 
+_IDENT_START = 1
+_IDENT_CONTINUE = 2
+
+# Classification of every ASCII character, indexed by code point
+_ASCII_CLASS: List[int] = [
+    (_IDENT_START | _IDENT_CONTINUE) if chr(c).isalpha() or chr(c) == "_"
+    else _IDENT_CONTINUE if chr(c).isdigit()
+    else 0
+    for c in range(128)
+]
+
+_ASCII_IDENTIFIER_RUN = re.compile(r"[A-Za-z0-9_]+")
+
+
+@lru_cache(maxsize=None)
+def _unicode_class(ch: str) -> int:
+    cat = unicodedata.category(ch)
+    if cat[0] == "L":
+        return _IDENT_START | _IDENT_CONTINUE
+    if cat[0] == "N":
+        return _IDENT_CONTINUE
+    return 0
+
+
 def is_identifier_ch(ch: Optional[str], can_be_digit: bool) -> bool:
     if ch is None:
         return False
 
-    if ch == "_":
-        return True
+    code = ord(ch)
+    cls = _ASCII_CLASS[code] if code < 128 else _unicode_class(ch)
+    return bool(cls & (_IDENT_CONTINUE if can_be_digit else _IDENT_START))
 
-    cat = unicodedata.category(ch)
-    if cat[0] == "L":
-        return True
 
-    if can_be_digit:
-        if cat[0] == "N":
-            return True
+# Gives every distinct identifier spelling a small integer id, the symbol of the
+# Identifier tokens spelled that way. Macros, parameters and the macros disabled during
+# an expansion are keyed by symbol, so comparing names is comparing ints. Symbols are
+# only meaningful within one process
+class SymbolTable:
+    def __init__(self) -> None:
+        self.symbols: Dict[str, int] = {}
+        self.names: List[str] = []  # indexed by symbol
+
+    def intern(self, name: str) -> int:
+        symbol = self.symbols.get(name)
+        if symbol is None:
+            symbol = self.symbols[name] = len(self.names)
+            self.names.append(name)
+        return symbol
 
-    return False
+    def name(self, symbol: int) -> str:
+        return self.names[symbol]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+SYMBOLS = SymbolTable()
 
 
 class Identifier(ProperPPToken):
+    # Set on copies of identifiers that must never be expanded as a macro, see paint
+    painted = False
+
     def __init__(
         self, span: Span, identifier: str
     ):  # identifier has universal names expanded
         super().__init__(span)
 
         self.identifier = identifier
+        self.symbol = SYMBOLS.intern(identifier)
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.identifier})"
@@ -133,8 +183,13 @@ class Identifier(ProperPPToken):
         else:
             raise TokenizeException("Expected identifier", inp.point_span())
 
+        contents = inp.source.contents
         while True:
-            if is_identifier_ch(inp.peek(1), True):
+            run = _ASCII_IDENTIFIER_RUN.match(contents, inp.idx)
+            if run is not None:
+                identifier += run.group()
+                inp.idx = run.end()
+            elif is_identifier_ch(inp.peek(1), True):
                 ch, _ = inp.pop(1)
                 identifier += ch  # type: ignore # we know ctx.pop(1) must be valid
             elif UniversalCharacterName.is_valid(inp):
@@ -144,9 +199,9 @@ class Identifier(ProperPPToken):
 
         span = Span(inp.source, start, inp.idx)
 
-        for kw in sorted(list(KeywordType), key=lambda x: len(x.value), reverse=True):
-            if kw.value == identifier:
-                return Keyword(span, kw)
+        kw = KEYWORDS.get(identifier)
+        if kw is not None:
+            return Keyword(span, kw)
 
         return Identifier(span, identifier)
 
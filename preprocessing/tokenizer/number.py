@@ -1,8 +1,8 @@
 from __future__ import annotations
 from typing import List, Optional, Union
+import re
 
 from .tokenize import LexicalElement, ProperPPToken, TokenizeException, expect
-from .escape import EscapeSequence
 from .identifier import is_identifier_ch
 from span import Span, SourceStream
 
@@ -86,44 +86,133 @@ class Dot(LexicalElement):
         return inp.peek_exact(".")
 
 
+# The ASCII part of a pp-number after its first digit
+_PP_NUMBER_RUN = re.compile(r"(?:[eEpP][+-]|[0-9A-Za-z_.])+")
+
+_INTEGER = re.compile(
+    r"(?:0[xX](?P<hex>[0-9a-fA-F]+)|0[bB](?P<bin>[01]+)|(?P<oct>0[0-7]*)|(?P<dec>[1-9][0-9]*))"
+    r"(?P<suffix>(?:[uU](?:ll|LL|[lL])?|(?:ll|LL|[lL])[uU]?)?)"
+)
+_DECIMAL_FLOAT = re.compile(
+    r"(?P<num>(?:[0-9]*\.[0-9]+|[0-9]+\.?)(?:[eE][+-]?[0-9]+)?)(?P<suffix>[fFlL]?)"
+)
+_HEX_FLOAT = re.compile(
+    r"(?P<num>0[xX](?:[0-9a-fA-F]*\.[0-9a-fA-F]+|[0-9a-fA-F]+\.?)[pP][+-]?[0-9]+)(?P<suffix>[fFlL]?)"
+)
+
+
+# Value of an integer or floating constant, as used by #if and friends
+class NumberValue:
+    def __init__(self, value: Union[int, float], suffix: str) -> None:
+        self.value = value
+        self.suffix = suffix
+
+    @property
+    def is_float(self) -> bool:
+        return isinstance(self.value, float)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.value!r}, suffix={self.suffix!r})"
+
+
+# Returns None if spelling is a pp-number but not a valid constant, like 1.2.3 or 0x
+def parse_number(spelling: str) -> Optional[NumberValue]:
+    m = _INTEGER.fullmatch(spelling)
+    if m is not None:
+        if m.group("hex") is not None:
+            value = int(m.group("hex"), 16)
+        elif m.group("bin") is not None:
+            value = int(m.group("bin"), 2)
+        elif m.group("oct") is not None:
+            value = int(m.group("oct"), 8)
+        else:
+            value = int(m.group("dec"))
+        return NumberValue(value, m.group("suffix"))
+
+    m = _DECIMAL_FLOAT.fullmatch(spelling)
+    if m is not None and not spelling.isdigit():
+        return NumberValue(float(m.group("num")), m.group("suffix"))
+
+    m = _HEX_FLOAT.fullmatch(spelling)
+    if m is not None:
+        return NumberValue(float.fromhex(m.group("num")), m.group("suffix"))
+
+    return None
+
+
+_UNPARSED = NumberValue(0, "")  # sentinel, as None means invalid
+
+
+# Only the span is stored. The per-character view and the value are computed on demand
 class PPNumber(ProperPPToken):
-    def __init__(
-        self, span: Span, number_content: List[Union[Digit, Exponent, Dot, str]]
-    ) -> None:
+    def __init__(self, span: Span) -> None:
         super().__init__(span)
 
-        self.number_content = number_content
+        self._number_content: Optional[List[Union[Digit, Exponent, Dot, str]]] = None
+        self._value: Optional[NumberValue] = _UNPARSED
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.number_content!r})"
 
-    @staticmethod
-    def tokenize(inp: SourceStream) -> PPNumber:
-        start = inp.idx
+    @property
+    def number_content(self) -> List[Union[Digit, Exponent, Dot, str]]:
+        if self._number_content is None:
+            self._number_content = self._split()
+        return self._number_content
 
+    def _split(self) -> List[Union[Digit, Exponent, Dot, str]]:
+        spelling = self.span.contents()
         content: List[Union[Digit, Exponent, Dot, str]] = []
 
-        if Dot.is_valid(inp):
-            content.append(Dot.tokenize(inp))
+        i = 0
+        while i < len(spelling):
+            ch = spelling[i]
+            if ch in Digit.CHARS:
+                content.append(Digit(self.span.sub(i, i + 1), int(ch)))
+            elif ch == ".":
+                content.append(Dot(self.span.sub(i, i + 1)))
+            elif ch in "eEpP" and spelling[i + 1 : i + 2] in ("+", "-"):
+                content.append(
+                    Exponent(
+                        self.span.sub(i, i + 2),
+                        ch.lower() == "e",
+                        ch.isupper(),
+                        spelling[i + 1] == "+",
+                    )
+                )
+                i += 1
+            else:
+                content.append(ch)
+            i += 1
 
-        if not Digit.is_valid(inp):
-            raise TokenizeException("Expected digit", inp.point_span())
+        return content
 
-        content.append(Digit.tokenize(inp))
+    # None if this isn't a valid integer or floating constant
+    @property
+    def value(self) -> Optional[NumberValue]:
+        if self._value is _UNPARSED:
+            self._value = parse_number(self.span.contents())
+        return self._value
+
+    @staticmethod
+    def tokenize(inp: SourceStream) -> PPNumber:
+        start = inp.idx
+        contents = inp.source.contents
+
+        if not PPNumber.is_valid(inp):
+            raise TokenizeException("Expected digit", inp.point_span())
+        inp.idx += 2 if contents[start] == "." else 1
 
         while True:
-            if Digit.is_valid(inp):
-                content.append(Digit.tokenize(inp))
-            elif Exponent.is_valid(inp):
-                content.append(Exponent.tokenize(inp))
+            run = _PP_NUMBER_RUN.match(contents, inp.idx)
+            if run is not None:
+                inp.idx = run.end()
             elif is_identifier_ch(inp.peek(1), can_be_digit=False):
-                ch, _ = inp.pop(1)
-                assert ch is not None
-                content.append(ch)
+                inp.idx += 1
             else:
                 break
 
-        return PPNumber(Span(inp.source, start, inp.idx), content)
+        return PPNumber(Span(inp.source, start, inp.idx))
 
     @staticmethod
     def is_valid(inp: SourceStream) -> bool:
@@ -0,0 +1,76 @@
+from __future__ import annotations
+from array import array
+from typing import Dict, List
+import re
+
+from span import Source, SplicedSource
+from stats import STATS
+from .tokenize import USE_TRIGRAPHS
+
+
+TRIGRAPHS: Dict[str, str] = {
+    "??=": "#",
+    "??(": "[",
+    "??/": "\\",
+    "??)": "]",
+    "??'": "^",
+    "??<": "{",
+    "??!": "|",
+    "??>": "}",
+    "??-": "~",
+}
+
+# A trigraph for a backslash followed by a newline is a line splice too
+_PHASE_1_2 = re.compile(r"\?\?/\n|\\\n|\?\?[=(/)'<!>-]" if USE_TRIGRAPHS else r"\\\n")
+
+
+# Runs translation phases 1 and 2 over the whole file, replacing trigraphs and removing
+# line splices, so the tokenizer never has to look for them. Files with neither are
+# returned as they are. The result is cached on the source, so a header included
+# several times is only translated once
+def translate_phases_1_2(source: Source) -> Source:
+    if source.translated is not None:
+        return source.translated
+
+    contents = source.contents
+    if "\\\n" not in contents and not (USE_TRIGRAPHS and "??" in contents):
+        source.translated = source
+        return source
+
+    with STATS.phase("phases_1_2"):
+        pieces: List[str] = []
+        starts = array("q")
+        raw_starts = array("q")
+        raw_ends = array("q")
+        clean_len = 0
+
+        def segment(text: str, raw_start: int, raw_end: int) -> None:
+            nonlocal clean_len
+            if not text:
+                return
+            pieces.append(text)
+            starts.append(clean_len)
+            raw_starts.append(raw_start)
+            raw_ends.append(raw_end)
+            clean_len += len(text)
+
+        pos = 0
+        for m in _PHASE_1_2.finditer(contents):
+            segment(contents[pos : m.start()], pos, m.start())
+            if not m.group().endswith("\n"):
+                segment(TRIGRAPHS[m.group()], m.start(), m.end())
+            pos = m.end()
+        segment(contents[pos:], pos, len(contents))
+        segment_count = len(starts)
+
+        # The empty segment at the end, see SplicedSource
+        starts.append(clean_len)
+        raw_starts.append(len(contents))
+        raw_ends.append(len(contents))
+
+        translated = SplicedSource(source, "".join(pieces), starts, raw_starts, raw_ends)
+
+    STATS.count("translated_files")
+    STATS.count("translated_segments", segment_count)
+    source.translated = translated
+    return translated
@@ -2,17 +2,18 @@ from __future__ import annotations
 from typing import Dict, Any
 from enum import Enum
 
-from .tokenize import LexicalElement, ProperPPToken, TokenizeException, USE_TRIGRAPHS
+from .tokenize import LexicalElement, ProperPPToken, TokenizeException
 from span import Span, SourceStream
 
 
+# Trigraph spellings are replaced before tokenizing, see translate_phases_1_2
 class PunctuatorType(Enum):
-    OPEN_BRACKET = ["[", "<:"] + USE_TRIGRAPHS * ["??("]
-    CLOSE_BRACKET = ["]", ":>"] + USE_TRIGRAPHS * ["??)"]
+    OPEN_BRACKET = ["[", "<:"]
+    CLOSE_BRACKET = ["]", ":>"]
     OPEN_PAREN = ["("]
     CLOSE_PAREN = [")"]
-    OPEN_BRACE = ["{", "<%"] + USE_TRIGRAPHS * ["??<"]
-    CLOSE_BRACE = ["}", "%>"] + USE_TRIGRAPHS * ["??>"]
+    OPEN_BRACE = ["{", "<%"]
+    CLOSE_BRACE = ["}", "%>"]
 
     DOT = ["."]
     ARROW = ["->"]
@@ -24,7 +25,7 @@ class PunctuatorType(Enum):
     ASTERISK = ["*"]
     PLUS = ["+"]
     MINUS = ["-"]
-    TILDE = ["~"] + USE_TRIGRAPHS * ["??-"]
+    TILDE = ["~"]
     EXCLAMATION_MARK = ["!"]
     SLASH = ["/"]
     PERCENT = ["%"]
@@ -36,7 +37,7 @@ class PunctuatorType(Enum):
     GREATER_THAN_EQUAL = [">="]
     DOUBLE_EQUAL = ["=="]
     BANG_EQUAL = ["!="]
-    CARET = ["^"] + USE_TRIGRAPHS * ["??'"]
+    CARET = ["^"]
     BAR = ["|"]
     DOUBLE_AMPERSAND = ["&&"]
     DOUBLE_BAR = ["||"]
@@ -58,17 +59,17 @@ class PunctuatorType(Enum):
     BAR_EQUAL = ["|="]
 
     COMMA = [","]
-    HASH = ["#", "%:"] + USE_TRIGRAPHS * ["??="]
-    DOUBLE_HASH = ["##", "%:%:"] + USE_TRIGRAPHS * ["??=??="]
+    HASH = ["#", "%:"]
+    DOUBLE_HASH = ["##", "%:%:"]
 
     @staticmethod
     def lookup() -> Dict[str, PunctuatorType]:
-        table = {}
-        for punct in PunctuatorType:
-            for val in punct.value:
-                table[val] = punct
+        return _LOOKUP
 
-        return table
+
+_LOOKUP: Dict[str, PunctuatorType] = {
+    val: punct for punct in PunctuatorType for val in punct.value
+}
 
 
 class Punctuator(ProperPPToken):
@@ -2,7 +2,7 @@ from __future__ import annotations
 from enum import Enum
 
 from .tokenize import LexicalElement, ProperPPToken, TokenizeException, expect
-from .escape import EscapeSequence
+from .escape import scan_quoted, unescape
 from span import Span, SourceStream
 from typing import Optional
 
@@ -15,13 +15,27 @@ class StringPrefix(Enum):
     NONE = ""
 
 
+# First character of every prefixed or unprefixed literal
+LITERAL_START = {pref.value[:1] or '"' for pref in StringPrefix}
+
+
 # Represents both the string-literal and the second variant of header-name
 class StringLiteral(ProperPPToken):
-    def __init__(self, span: Span, prefix: StringPrefix, contents: str) -> None:
+    # contents is decoded from the span on first access if not given
+    def __init__(
+        self, span: Span, prefix: StringPrefix, contents: Optional[str] = None
+    ) -> None:
         super().__init__(span)
 
         self.prefix = prefix
-        self.contents = contents  # Escape sequences escaped
+        self._contents = contents
+
+    @property
+    def contents(self) -> str:  # Escape sequences escaped
+        if self._contents is None:
+            body = self.span.contents()[len(self.prefix.value) + 1 : -1]
+            self._contents = unescape(body)
+        return self._contents
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(prefix={self.prefix.name},contents={self.contents!r})"
@@ -41,27 +55,16 @@ class StringLiteral(ProperPPToken):
             raise TokenizeException("Expected string", inp.point_span())
 
         expect(prefix.value + '"', inp)
+        scan_quoted(inp, '"')
 
-        contents = ""
-        while True:
-            if inp.peek_exact('"'):
-                inp.pop(1)
-                break
-
-            if EscapeSequence.is_valid(inp):
-                esc = EscapeSequence.tokenize(inp)
-                contents += esc.unescape()
-            else:
-                ch, _ = inp.pop(1)
-                if ch is None:
-                    raise TokenizeException("EOF in string literal", inp.point_span())
-
-                contents += ch
-
-        return StringLiteral(Span(inp.source, start, inp.idx), prefix, contents)
+        return StringLiteral(Span(inp.source, start, inp.idx), prefix)
 
     @staticmethod
     def is_valid(inp: SourceStream) -> bool:
+        # Cheap rejection, as this is probed before every identifier
+        first = inp.peek(1)
+        if first is None or first not in LITERAL_START:
+            return False
         for pref in StringPrefix:
             if inp.peek_exact(pref.value + '"'):
                 return True
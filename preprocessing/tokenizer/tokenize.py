@@ -3,9 +3,14 @@ from abc import ABC, abstractmethod
 from span import Span, SourceStream
 from enum import Enum
 from typing import Optional, List
+import re
 
 USE_TRIGRAPHS = True
 
+# A run of spaces and newlines. Line splices are removed before tokenizing, see
+# translate_phases_1_2
+_SPACE_RUN = re.compile(r"[ \n]+")
+
 
 class TokenizeException(Exception):
     def __init__(self, msg: str, span: Span) -> None:
@@ -45,6 +50,13 @@ class Tokenizable(ABC):
 
 
 class LexicalElement(Tokenizable):
+    # Set by the tokenizer on the first token of each line, not counting whitespace and
+    # comments. Only stored on the tokens where it's true
+    at_bol = False
+    # Set on tokens that had whitespace or a comment right before them, when those aren't
+    # kept as elements of their own (-felide-whitespace). Only stored where it's true
+    space_before = False
+
     @staticmethod
     def tokenize(inp: SourceStream) -> LexicalElement:
         if SpaceSequence.is_valid(inp):
@@ -78,44 +90,24 @@ class SpaceSequence(LexicalElement):
             return Comment.tokenize(inp)
 
         start = inp.idx
-
-        has_nl = False
-        has_any = False
-
-        while True:
-            if inp.pop_exact("\\\n"):
-                has_any = True
-                continue
-            elif inp.pop_exact("\n"):
-                has_nl = True
-                has_any = True
-                continue
-            elif inp.pop_exact(" "):
-                has_any = True
-                continue
-            elif USE_TRIGRAPHS and inp.pop_exact("??/\n"):
-                has_any = True
-                continue
-            else:
-                break
-
-        if not has_any:
+        m = _SPACE_RUN.match(inp.source.contents, start)
+        if m is None:
             raise TokenizeException("Expected spaces", inp.point_span())
+        inp.idx = m.end()
 
+        has_nl = "\n" in m.group()
         return SpaceSequence(Span(inp.source, start, inp.idx), has_nl)
 
     @staticmethod
     def is_valid(inp: SourceStream) -> bool:
         from .comment import Comment
 
-        if Comment.is_valid(inp):
+        ch = inp.peek(1)
+        if ch == " " or ch == "\n":
             return True
-
-        if USE_TRIGRAPHS:
-            if inp.peek_exact("??/\n"):
-                return True
-
-        return inp.peek_exact("\n") or inp.peek_exact(" ") or inp.peek_exact("\\\n")
+        if ch == "/":
+            return Comment.is_valid(inp)
+        return False
 
 
 class PPToken(LexicalElement):
@@ -174,12 +166,13 @@ class ProperPPToken(PPToken):
         if Identifier.is_valid(inp):
             return Identifier.tokenize(inp)
 
-        if Punctuator.is_valid(inp):
-            return Punctuator.tokenize(inp)
-
+        # Before Punctuator, so .5 isn't read as a dot
         if PPNumber.is_valid(inp):
             return PPNumber.tokenize(inp)
 
+        if Punctuator.is_valid(inp):
+            return Punctuator.tokenize(inp)
+
         raise TokenizeException("Expected preprocessing token", inp.point_span())
 
     @staticmethod
@@ -1,6 +1,10 @@
 from __future__ import annotations
+import bisect
 import random
-from typing import List, Tuple, Optional, Union, Dict, Set
+import sys
+import threading
+from array import array
+from typing import List, Tuple, Optional, Union, Dict, Set, TextIO
 from enum import Enum
 
 RESET = "\033[0m"
@@ -36,13 +40,28 @@ class DownSpan:
 class PseudoFilename(Enum):
     NULL = "Null file"
     PREDEFINED_MACROS = "Predefined macros"
+    SCRATCH = "Scratch space"  # tokens made by # and ##
 
 
 class Source:
+    # Characters of the offset space reserved for the source, if more than its contents.
+    # See ScratchSource
+    capacity = 0
+
     def __init__(self, filename: Union[str, PseudoFilename], contents: str) -> None:
         self.filename = filename
         self.contents = contents
         self.lines = self.contents.split("\n")
+        self._line_starts: Optional[List[int]] = None
+
+        # The file as written. Only differs for a SplicedSource
+        self.original: Source = self
+        # The SplicedSource made from this file, or the file itself if it needed no
+        # translation. Set by translate_phases_1_2
+        self.translated: Optional[Source] = None
+
+        # Where the source starts in the global offset space of SOURCES
+        self.id, self.base = SOURCES.register(self)
 
     def __str__(self) -> str:
         linecount = len(self.lines)
@@ -51,178 +70,363 @@ class Source:
     def __repr__(self) -> str:
         return str(self)
 
+    def line_starts(self) -> List[int]:
+        if self._line_starts is None:
+            starts = [0]
+            for line in self.lines[:-1]:
+                starts.append(starts[-1] + len(line) + 1)
+            self._line_starts = starts
+        return self._line_starts
+
     def coords_for_offset(self, offset: int) -> Tuple[int, int]:  # (line, col)
-        line = self.contents[:offset].count("\n")
-        col0 = sum(len(line_before) + 1 for line_before in self.lines[:line])
-        col = offset - col0
+        # Same as counting the newlines in self.contents[:offset], including for negative offsets
+        prefix_len = offset if offset >= 0 else len(self.contents) + offset
+        prefix_len = min(max(prefix_len, 0), len(self.contents))
+        starts = self.line_starts()
+        line = bisect.bisect_right(starts, prefix_len) - 1
+        col = offset - starts[line]
 
         # assert(self.contents[offset] == self.lines[line][col])
         return line, col
 
+    # Maps an offset into this source to an offset into self.original
+    def original_offset(self, offset: int) -> int:
+        return offset
+
+    # Same as original_offset, for the exclusive end of a span
+    def original_end(self, offset: int) -> int:
+        return offset
+
+    # Only the lines within ctx_dist rows of a span marker are visited, so the cost is
+    # proportional to the number of spans rather than the length of the file
     def print_spans(
-        self, spans: List[Tuple[Span, MarkColor]], ctx_dist: int = 2
+        self,
+        spans: List[Tuple[Span, MarkColor]],
+        ctx_dist: int = 2,
+        file: Optional[TextIO] = None,
     ) -> None:
-        lines: List[Union[str, UpSpan, DownSpan, DualSpan]] = list(self.lines)
-        linenums: List[Optional[int]] = list(range(len(lines)))
+        # Rows are sorted by (line, order, tiebreak). Markers before a line have order 0, the
+        # line itself 1 and markers after it 2. Markers after a line are placed in reverse
+        # order, so the marker of the last span ends up closest to its line
+        rows: List[Tuple[int, int, int, Union[None, UpSpan, DownSpan, DualSpan]]] = []
+        visible: Set[int] = set()
+
+        def show(first: int, last: int) -> None:
+            for line in range(max(first, 0), min(last, len(self.lines) - 1) + 1):
+                visible.add(line)
 
         for i, (span, _) in enumerate(spans):
             start_line, start_col = self.coords_for_offset(span.start)
             end_line, end_col = self.coords_for_offset(span.end - 1)
 
             if start_line == end_line:
-                idx = linenums.index(start_line) + 1
-                lines.insert(idx, DualSpan(i, start_col, end_col))
-                linenums.insert(idx, None)
+                rows.append((start_line, 2, -i, DualSpan(i, start_col, end_col)))
+                show(start_line - ctx_dist + 1, start_line + ctx_dist)
             else:
-                start_idx = linenums.index(start_line)
-                lines.insert(start_idx, DownSpan(i, start_col))
-                linenums.insert(start_idx, None)
-
-                end_idx = linenums.index(end_line) + 1
-                lines.insert(end_idx, UpSpan(i, end_col))
-                linenums.insert(end_idx, None)
-
-        dist_to_interesting = [float("inf") for _ in range(len(lines))]
-        curr_dist_up = float("inf")
-        for i in range(len(lines)):
-            curr_dist_up += 1
-            if not isinstance(lines[i], str):
-                curr_dist_up = 0
-            dist_to_interesting[i] = min(dist_to_interesting[i], curr_dist_up)
-
-        curr_dist_down = float("inf")
-        for i in range(len(lines) - 1, -1, -1):
-            curr_dist_down += 1
-            if not isinstance(lines[i], str):
-                curr_dist_down = 0
-            dist_to_interesting[i] = min(dist_to_interesting[i], curr_dist_down)
-
-        open_spans: List[Set[int]] = [set() for _ in range(len(lines))]
-        current_spans: Set[int] = set()
+                rows.append((start_line, 0, i, DownSpan(i, start_col)))
+                show(start_line - ctx_dist, start_line + ctx_dist - 1)
 
-        xs: Dict[int, int] = {}
+                rows.append((end_line, 2, -i, UpSpan(i, end_col)))
+                show(end_line - ctx_dist + 1, end_line + ctx_dist)
 
-        for i in range(len(lines)):
-            line = lines[i]
-            if isinstance(line, DownSpan):
-                max_x = max([-1] + [xs[j] for j in current_spans])
-                xs[line.span_idx] = max_x + 1
-                current_spans.add(line.span_idx)
+        for line in visible:
+            rows.append((line, 1, 0, None))
+        rows.sort(key=lambda row: row[:3])
 
-            open_spans[i] = set(current_spans)
-            if isinstance(line, UpSpan):
-                current_spans.remove(line.span_idx)
+        xs: Dict[int, int] = {}
+        current_spans: Set[int] = set()
+        for _, _, _, marker in rows:
+            if isinstance(marker, DownSpan):
+                xs[marker.span_idx] = max([-1] + [xs[j] for j in current_spans]) + 1
+                current_spans.add(marker.span_idx)
+            elif isinstance(marker, UpSpan):
+                current_spans.remove(marker.span_idx)
 
         left_width = max([-1] + list(xs.values())) + 1
         num_width = len(str(len(self.lines) - 1))
         num_pref = " ┃ "
         num_suff = " ┃ "
-        last_uninteresting = False
-        for i, line in enumerate(lines):
-            own_x = left_width + 10
 
+        def make_lhs(
+            open_spans: Set[int], marker: Union[None, UpSpan, DownSpan, DualSpan]
+        ) -> str:
             lhs_lst: List[str] = [" " for _ in range(left_width)]
-            if isinstance(line, (UpSpan, DownSpan)):
+            if isinstance(marker, (UpSpan, DownSpan)):
                 for x in range(left_width):
-                    if x > xs[line.span_idx]:
+                    if x > xs[marker.span_idx]:
                         lhs_lst[x] = (
-                            spans[line.span_idx][1].into_escape_code() + "─" + RESET
+                            spans[marker.span_idx][1].into_escape_code() + "─" + RESET
                         )
 
-            for x in open_spans[i]:
+            for x in open_spans:
                 lhs_lst[xs[x]] = spans[x][1].into_escape_code() + "│" + RESET
-                if isinstance(line, (UpSpan, DownSpan)):
-                    if xs[x] >= xs[line.span_idx]:
-                        if x == line.span_idx:
-                            lhs_lst[xs[x]] = "┌" if isinstance(line, DownSpan) else "└"
+                if isinstance(marker, (UpSpan, DownSpan)):
+                    if xs[x] >= xs[marker.span_idx]:
+                        if x == marker.span_idx:
+                            lhs_lst[xs[x]] = "┌" if isinstance(marker, DownSpan) else "└"
                         else:
                             lhs_lst[xs[x]] = "┼"
                         lhs_lst[xs[x]] = (
-                            spans[line.span_idx][1].into_escape_code()
+                            spans[marker.span_idx][1].into_escape_code()
                             + lhs_lst[xs[x]]
                             + RESET
                         )
 
-            lhs: str = "".join(lhs_lst)
+            return "".join(lhs_lst)
 
-            if dist_to_interesting[i] > ctx_dist:
-                if not last_uninteresting:
-                    print(lhs + num_pref + "." * num_width + num_suff + " <...>")
-                last_uninteresting = True
-                continue
-            last_uninteresting = False
+        out: List[str] = []
 
-            if isinstance(line, str):
-                print(
-                    f"{lhs}{num_pref}{str(linenums[i]).ljust(num_width)}{num_suff}{line}"
+        def elided() -> None:
+            lhs = make_lhs(current_spans, None)
+            out.append(lhs + num_pref + "." * num_width + num_suff + " <...>")
+
+        next_line = 0  # first source line that has neither been shown nor elided
+        current_spans = set()
+        for line_nr, order, _, marker in rows:
+            if next_line < line_nr + (order == 2):
+                elided()
+            next_line = line_nr + (order >= 1)
+
+            if isinstance(marker, DownSpan):
+                current_spans.add(marker.span_idx)
+            lhs = make_lhs(current_spans, marker)
+            if isinstance(marker, UpSpan):
+                current_spans.remove(marker.span_idx)
+
+            if marker is None:
+                out.append(
+                    f"{lhs}{num_pref}{str(line_nr).ljust(num_width)}{num_suff}{self.lines[line_nr]}"
                 )
-            elif isinstance(line, DownSpan):
-                print(
+            elif isinstance(marker, DownSpan):
+                out.append(
                     f"{lhs}"
-                    + spans[line.span_idx][1].into_escape_code()
-                    + "─" * (len(num_pref + num_suff) + num_width + line.col)
+                    + spans[marker.span_idx][1].into_escape_code()
+                    + "─" * (len(num_pref + num_suff) + num_width + marker.col)
                     + "┐"
                     + RESET
                 )
-            elif isinstance(line, UpSpan):
-                print(
+            elif isinstance(marker, UpSpan):
+                out.append(
                     f"{lhs}"
-                    + spans[line.span_idx][1].into_escape_code()
-                    + "─" * (len(num_pref + num_suff) + num_width + line.col)
+                    + spans[marker.span_idx][1].into_escape_code()
+                    + "─" * (len(num_pref + num_suff) + num_width + marker.col)
                     + "┘"
                     + RESET
                 )
-            elif isinstance(line, DualSpan):
-                if line.start_col == line.end_col:
-                    print(
+            elif isinstance(marker, DualSpan):
+                if marker.start_col == marker.end_col:
+                    out.append(
                         f"{lhs}"
-                        + spans[line.span_idx][1].into_escape_code()
+                        + spans[marker.span_idx][1].into_escape_code()
                         + num_pref
                         + " " * num_width
                         + num_suff
-                        + " " * (line.start_col)
+                        + " " * (marker.start_col)
                         + "↑"
                         + RESET
                     )
                 else:
-                    print(
+                    out.append(
                         f"{lhs}"
-                        + spans[line.span_idx][1].into_escape_code()
+                        + spans[marker.span_idx][1].into_escape_code()
                         + num_pref
                         + " " * num_width
                         + num_suff
-                        + " " * (line.start_col)
+                        + " " * (marker.start_col)
                         + "└"
-                        + "─" * (line.end_col - line.start_col - 1)
+                        + "─" * (marker.end_col - marker.start_col - 1)
                         + "┘"
                         + RESET
                     )
-            else:
-                print("death")
-
 
+        if next_line < len(self.lines):
+            elided()
+
+        (file or sys.stdout).write("".join(line + "\n" for line in out))
+
+
+# The text of a file after translation phases 1 and 2 (trigraph replacement and line
+# splicing), which is what the tokenizer reads. Spans into it are reported in terms of the
+# original file, through a map of the segments copied from it: segment i starts at
+# starts[i] here, and comes from original[raw_starts[i] : raw_ends[i]]. Segments are copied
+# verbatim, except for replaced trigraphs which are one character here. The last segment
+# is an empty one at the end of both files
+class SplicedSource(Source):
+    def __init__(
+        self,
+        original: Source,
+        contents: str,
+        starts: array[int],
+        raw_starts: array[int],
+        raw_ends: array[int],
+    ) -> None:
+        super().__init__(original.filename, contents)
+        self.original = original
+        self.starts = starts
+        self.raw_starts = raw_starts
+        self.raw_ends = raw_ends
+
+    def original_offset(self, offset: int) -> int:
+        i = bisect.bisect_right(self.starts, offset) - 1
+        return self.raw_starts[i] + offset - self.starts[i]
+
+    # The end of the last character's segment when the span ends with one, so a span
+    # ending right before a splice doesn't cover it, and one ending in a trigraph covers
+    # all of it
+    def original_end(self, offset: int) -> int:
+        i = bisect.bisect_left(self.starts, offset) - 1
+        if i < 0:
+            return offset
+        if i + 1 < len(self.starts) and offset == self.starts[i + 1]:
+            return self.raw_ends[i]
+        return self.raw_starts[i] + offset - self.starts[i]
+
+
+# A source that text is appended to, for tokens made while preprocessing, like the
+# results of # and ##. Its range of the offset space is reserved up front, so text can
+# be added without registering a new Source every time
+class ScratchSource(Source):
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        super().__init__(PseudoFilename.SCRATCH, "")
+
+    # Adds text and a newline after it. Returns the offset of text, or None if there isn't
+    # room for it
+    def append(self, text: str) -> Optional[int]:
+        start = len(self.contents)
+        if start + len(text) + 1 > self.capacity:
+            return None
+        self.contents += text + "\n"
+        new_lines = text.split("\n")
+        self.lines[-1] += new_lines[0]
+        self.lines.extend(new_lines[1:])
+        self.lines.append("")
+        self._line_starts = None
+        return start
+
+
+# Every Source is registered once under a small integer id, and gets its own range of a
+# global offset space, one past its end being reserved so a zero-length span at the end of
+# a file still maps back to it. Like clang's SourceManager, this lets a Span be just two
+# ints, with the Source looked up when it's needed.
+# Files read through CompilationCtx are registered by path, so headers included more than
+# once are only read and stored once
+class SourceManager:
+    # Characters reserved for each scratch source. Every append copies its contents, so
+    # this is kept small
+    SCRATCH_CAPACITY = 1 << 16
+
+    def __init__(self) -> None:
+        self.sources: List[Source] = []
+        self.bases: List[int] = []
+        self.next_base = 0
+        self.files: Dict[str, Source] = {}
+
+        self._lock = threading.Lock()
+        self._last: Optional[Source] = None  # most spans are looked up in the file last used
+        self._scratch: Optional[ScratchSource] = None
+
+    # Returns (id, base)
+    def register(self, source: Source) -> Tuple[int, int]:
+        with self._lock:
+            source_id = len(self.sources)
+            base = self.next_base
+            self.sources.append(source)
+            self.bases.append(base)
+            self.next_base = base + max(len(source.contents), source.capacity) + 1
+            return source_id, base
+
+    def source_at(self, offset: int) -> Source:
+        last = self._last
+        if last is not None and last.base <= offset <= last.base + len(last.contents):
+            return last
+        source = self.sources[bisect.bisect_right(self.bases, offset) - 1]
+        self._last = source
+        return source
+
+    # Adds text to the scratch source, starting a new one when it's full. Returns the source
+    # and the offset of text in it
+    def add_scratch(self, text: str) -> Tuple[Source, int]:
+        scratch = self._scratch
+        start = scratch.append(text) if scratch is not None else None
+        if scratch is None or start is None:
+            scratch = self._scratch = ScratchSource(max(self.SCRATCH_CAPACITY, len(text) + 1))
+            start = scratch.append(text)
+            assert start is not None
+        return scratch, start
+
+    # key is the normalized path of the file
+    def find_file(self, key: str) -> Optional[Source]:
+        return self.files.get(key)
+
+    def add_file(self, key: str, filename: str, contents: str) -> Source:
+        source = self.files[key] = Source(filename, contents)
+        return source
+
+
+SOURCES = SourceManager()
+
+
+# Offsets into the global offset space, see SourceManager
 class Span:
+    __slots__ = ("lo", "hi")
+
     def __init__(self, source: Source, start: int, end: int) -> None:
         assert end >= start
 
-        self.source = source
-        self.start = start
-        self.end = end
+        self.lo = source.base + start
+        self.hi = source.base + end
+
+    @staticmethod
+    def from_offsets(lo: int, hi: int) -> Span:
+        span = Span.__new__(Span)
+        span.lo = lo
+        span.hi = hi
+        return span
+
+    # source, start and end are in terms of the original file, even for spans into the
+    # SplicedSource the tokenizer read. contents() is the spelling the tokenizer saw
+    @property
+    def source(self) -> Source:
+        return SOURCES.source_at(self.lo).original
+
+    @property
+    def start(self) -> int:
+        source = SOURCES.source_at(self.lo)
+        if source.original is source:
+            return self.lo - source.base
+        return source.original_offset(self.lo - source.base)
+
+    @property
+    def end(self) -> int:
+        source = SOURCES.source_at(self.lo)
+        if source.original is source:
+            return self.hi - source.base
+        if self.hi == self.lo:
+            return source.original_offset(self.lo - source.base)
+        return source.original_end(self.hi - source.base)
+
+    # The part of this span from start to end, relative to its contents()
+    def sub(self, start: int, end: int) -> Span:
+        assert 0 <= start <= end
+        return Span.from_offsets(self.lo + start, self.lo + end)
 
     def combine(self, other: Span) -> Span:
         assert other.source == self.source
-        assert other.end > self.start
-        return Span(self.source, self.start, other.end)
+        assert other.hi > self.lo
+        return Span.from_offsets(self.lo, other.hi)
 
     def contents(self) -> str:
-        return self.source.contents[self.start : self.end]
+        source = SOURCES.source_at(self.lo)
+        return source.contents[self.lo - source.base : self.hi - source.base]
 
 
 class NullSpan(Span):
+    __slots__ = ()
+
     def __init__(self, source: Source) -> None:
-        self.source = source
-        self.start = 0
-        self.end = 0
+        self.lo = source.base
+        self.hi = source.base
 
     def combine(self, other: Span) -> Span:
         return other
@@ -240,7 +444,7 @@ class SourceStream:
         if self.idx + tok_len > len(self.source.contents):
             return None, Span(self.source, self.idx, len(self.source.contents))
         else:
-            res = self.source.contents[self.idx :][:tok_len]
+            res = self.source.contents[self.idx : self.idx + tok_len]
             start = self.idx
             self.idx += tok_len
             return res, Span(self.source, start, self.idx)
@@ -249,7 +453,7 @@ class SourceStream:
         if self.idx + tok_len > len(self.source.contents):
             return None
         else:
-            return self.source.contents[self.idx :][:tok_len]
+            return self.source.contents[self.idx : self.idx + tok_len]
 
     def peek_exact(self, wanted: str) -> bool:
         return self.peek(len(wanted)) == wanted
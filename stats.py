@@ -0,0 +1,310 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Any
+import json
+import os
+import time
+
+from span import Source
+
+
+# Accumulated timings for one phase or directive kind.
+# `inclusive` contains the time spent in nested phases, `exclusive` does not
+class PhaseStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "inclusive_s": self.inclusive,
+            "exclusive_s": self.exclusive,
+        }
+
+
+class TokenStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.chars = 0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"count": self.count, "chars": self.chars}
+
+
+# One inclusion of a file. Headers are not nested in the token stream after being spliced
+# in, so the costs are attributed through the file each directive was read from.
+class HeaderNode:
+    def __init__(self, filename: str, parent: Optional[HeaderNode]) -> None:
+        self.filename = filename
+        self.parent = parent
+        self.children: List[HeaderNode] = []
+
+        self.load_time = 0.0  # resolve, read, tokenize and splice of the #include
+        self.directive_time = 0.0  # directives in this file, excluding loading the headers they include
+        self.tokens = 0
+
+    def exclusive_time(self) -> float:
+        return self.load_time + self.directive_time
+
+    def inclusive_time(self) -> float:
+        return self.exclusive_time() + sum(c.inclusive_time() for c in self.children)
+
+    def inclusive_tokens(self) -> int:
+        return self.tokens + sum(c.inclusive_tokens() for c in self.children)
+
+
+class HeaderTotals:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.inclusions = 0
+        self.inclusive_time = 0.0
+        self.exclusive_time = 0.0
+        self.inclusive_tokens = 0
+        self.exclusive_tokens = 0
+
+
+class _NullTimer:
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+
+# Shared by every disabled call site, so a disabled `with STATS.phase(...)` allocates nothing
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(
+        self,
+        stats: Stats,
+        entry: PhaseStats,
+        name: str,
+        category: str,
+        header: Optional[HeaderNode] = None,
+        args: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.stats = stats
+        self.entry = entry
+        self.name = name
+        self.category = category
+        self.header = header
+        self.args = args
+        self.start = 0.0
+        self.child_time = 0.0
+
+    def __enter__(self) -> None:
+        self.stats._stack.append(self)
+        self.start = time.perf_counter()
+        if self.stats.trace_events is not None:
+            self.stats._trace_event("B", self.name, self.category, self.start, self.args)
+
+    def __exit__(self, *exc: Any) -> None:
+        end = time.perf_counter()
+        elapsed = end - self.start
+        self.stats._stack.pop()
+        if self.stats.trace_events is not None:
+            self.stats._trace_event("E", self.name, self.category, end, None)
+
+        self.entry.calls += 1
+        self.entry.inclusive += elapsed
+        self.entry.exclusive += elapsed - self.child_time
+
+        if self.header is not None:
+            self.header.directive_time += elapsed - self.child_time
+
+        if self.stats._stack:
+            self.stats._stack[-1].child_time += elapsed
+
+
+# Collects timers and counters for the phases of the preprocessor.
+# Everything is a no-op unless `enabled` is set, which is done by passing --stats or --trace
+class Stats:
+    def __init__(self) -> None:
+        self.enabled = False
+        # Chrome trace-event records, only collected when not None
+        self.trace_events: Optional[List[Dict[str, Any]]] = None
+        # Every inclusion gets its own node. A file included more than once shares one
+        # Source, so headers maps it to its latest inclusion, which is the one being run
+        self.header_nodes: List[HeaderNode] = []
+        self.headers: Dict[Source, HeaderNode] = {}
+
+        self.phases: Dict[str, PhaseStats] = {}
+        self.directives: Dict[str, PhaseStats] = {}
+        self.tokens: Dict[str, TokenStats] = {}
+        self.counters: Dict[str, int] = {}
+
+        self._stack: List[_Timer] = []
+
+    def phase(self, name: str, args: Optional[Dict[str, Any]] = None) -> Any:
+        if not self.enabled:
+            return NULL_TIMER
+        entry = self.phases.setdefault(name, PhaseStats())
+        return _Timer(self, entry, name, "phase", args=args)
+
+    # source is the file the directive was read from
+    def directive(self, name: str, source: Source) -> Any:
+        if not self.enabled:
+            return NULL_TIMER
+        entry = self.directives.setdefault(name, PhaseStats())
+        header = self.header(source)
+        return _Timer(
+            self, entry, "#" + name, "directive", header, {"file": header.filename}
+        )
+
+    def header(self, source: Source) -> HeaderNode:
+        node = self.headers.get(source)
+        if node is None:
+            node = self._new_header(source, None)
+        return node
+
+    def _new_header(self, source: Source, parent: Optional[HeaderNode]) -> HeaderNode:
+        node = self.headers[source] = HeaderNode(str(source.filename), parent)
+        self.header_nodes.append(node)
+        if parent is not None:
+            parent.children.append(node)
+        return node
+
+    def record_include(
+        self, includer: Source, included: Source, tokens: int, load_time: float
+    ) -> None:
+        node = self._new_header(included, self.header(includer))
+        node.tokens += tokens
+        node.load_time += load_time
+
+    def record_file_tokens(self, source: Source, tokens: int) -> None:
+        self.header(source).tokens += tokens
+
+    def _trace_event(
+        self,
+        ph: str,
+        name: str,
+        category: str,
+        timestamp: float,
+        args: Optional[Dict[str, Any]],
+    ) -> None:
+        assert self.trace_events is not None
+        event: Dict[str, Any] = {
+            "name": name,
+            "cat": category,
+            "ph": ph,
+            "ts": timestamp * 1e6,
+            "pid": os.getpid(),
+            "tid": 0,
+        }
+        if args is not None:
+            event["args"] = args
+        self.trace_events.append(event)
+
+    def write_trace(self, path: str) -> None:
+        with open(path, "w") as trace_file:
+            json.dump(
+                {"traceEvents": self.trace_events or [], "displayTimeUnit": "ms"},
+                trace_file,
+            )
+
+    # Per header file, summed over all of its inclusions. The main file is left out
+    def header_totals(self) -> List[HeaderTotals]:
+        totals: Dict[str, HeaderTotals] = {}
+        for node in self.header_nodes:
+            if node.parent is None:
+                continue
+            total = totals.get(node.filename)
+            if total is None:
+                total = totals[node.filename] = HeaderTotals(node.filename)
+            total.inclusions += 1
+            total.inclusive_time += node.inclusive_time()
+            total.exclusive_time += node.exclusive_time()
+            total.inclusive_tokens += node.inclusive_tokens()
+            total.exclusive_tokens += node.tokens
+        return list(totals.values())
+
+    def render_header_report(self, top_n: int) -> str:
+        totals = self.header_totals()
+        out: List[str] = []
+
+        def ranking(title: str, key: Any) -> None:
+            out.append(
+                f"{title:<40}{'times':>8}{'incl ms':>12}{'excl ms':>12}"
+                f"{'incl toks':>12}{'excl toks':>12}"
+            )
+            for t in sorted(totals, key=key)[:top_n]:
+                out.append(
+                    f"  {t.filename:<38}{t.inclusions:>8}"
+                    f"{t.inclusive_time * 1000:>12.3f}{t.exclusive_time * 1000:>12.3f}"
+                    f"{t.inclusive_tokens:>12}{t.exclusive_tokens:>12}"
+                )
+            out.append("")
+
+        ranking(f"Top {top_n} headers by inclusive time", lambda t: -t.inclusive_time)
+        ranking(f"Top {top_n} headers by exclusive time", lambda t: -t.exclusive_time)
+        ranking(f"Top {top_n} headers by tokens", lambda t: -t.inclusive_tokens)
+
+        return "\n".join(out).rstrip("\n")
+
+    def count(self, name: str, amount: int = 1) -> None:
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # A counter holding the largest value seen
+    def maximum(self, name: str, value: int) -> None:
+        if not self.enabled:
+            return
+        if value > self.counters.get(name, 0):
+            self.counters[name] = value
+
+    # Call sites are expected to check `enabled` themselves, as this is called per token
+    def count_token(self, kind: str, chars: int) -> None:
+        entry = self.tokens.get(kind)
+        if entry is None:
+            entry = self.tokens[kind] = TokenStats()
+        entry.count += 1
+        entry.chars += chars
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "phases": {name: p.to_json() for name, p in self.phases.items()},
+            "directives": {name: p.to_json() for name, p in self.directives.items()},
+            "tokens": {name: t.to_json() for name, t in self.tokens.items()},
+            "counters": dict(self.counters),
+        }
+
+    def render_json(self) -> str:
+        return json.dumps(self.to_json(), indent=2)
+
+    def render_table(self) -> str:
+        out: List[str] = []
+
+        def timing_table(title: str, table: Dict[str, PhaseStats]) -> None:
+            out.append(f"{title:<24}{'calls':>10}{'incl ms':>12}{'excl ms':>12}")
+            for name, p in sorted(table.items(), key=lambda kv: -kv[1].inclusive):
+                out.append(
+                    f"  {name:<22}{p.calls:>10}"
+                    f"{p.inclusive * 1000:>12.3f}{p.exclusive * 1000:>12.3f}"
+                )
+            out.append("")
+
+        timing_table("Phase", self.phases)
+        timing_table("Directive", self.directives)
+
+        out.append(f"{'Token class':<24}{'count':>10}{'chars':>12}")
+        for name, t in sorted(self.tokens.items(), key=lambda kv: -kv[1].count):
+            out.append(f"  {name:<22}{t.count:>10}{t.chars:>12}")
+        out.append("")
+
+        out.append(f"{'Counter':<24}{'value':>10}")
+        for name, value in sorted(self.counters.items()):
+            out.append(f"  {name:<22}{value:>10}")
+
+        return "\n".join(out)
+
+    def render(self, fmt: Optional[str]) -> str:
+        if fmt == "json":
+            return self.render_json()
+        return self.render_table()
+
+
+STATS = Stats()
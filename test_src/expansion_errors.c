@@ -0,0 +1,14 @@
+// Errors while expanding macros. With -fcollect-errors every one is reported, the
+// invocations that failed are dropped, and everything around them is still expanded
+#define T(x) x
+#define CAT(a, b) a ## b
+#define DEEP(x) DEEP2(x)
+#define DEEP2(x) DEEP3(x)
+#define DEEP3(x) [x]
+
+int a = T(1, 2);
+int b = CAT(+, /);
+int c = T(3) + DEEP(4);
+int d = T(
+#define AFTER 5
+int e = AFTER;
@@ -0,0 +1,30 @@
+// Stringized arguments are spelled the same with and without -felide-whitespace
+#define S(x) #x
+#define XS(x) S(x)
+#define E2(x) x
+#define P(a, b) a##b
+#define EMPTY
+#define A +
+#define SP(x, y) x y
+#define GLUE(x, y) [ x ## y ]
+
+#define hash_hash # ## #
+#define mkstr(a) # a
+#define in_between(a) mkstr(a)
+#define join(c, d) in_between(c hash_hash d)
+
+const char *cases[] = {
+    XS(1 E2(a)),
+    XS(1 P(a,b)),
+    join(x, y),
+    XS(+E2(a)),
+    XS(-A),
+    XS(- A),
+    XS(1 EMPTY+),
+    XS(SP(a,b)),
+    XS(SP( , b)),
+    XS(GLUE(1 2, 3)),
+    XS(GLUE(, 3)),
+    XS(GLUE(p q, r s)),
+    XS(E2( a )E2(b)),
+};